@@ -0,0 +1,329 @@
+"""Offline benchmark: `python bench.py [--updates 5000] [--subs 10000,100000]`.
+
+Starts local stand-ins for the Telegram Bot API and the Upstash REST API in
+a child process (latency, 429 and 403 injection are configurable), points
+the bot at them and then:
+
+  * replays a synthetic corpus of messages, callbacks and join requests
+    against /webhook and reports p50/p95/p99 latency, updates/sec and
+    outbound calls per update;
+  * runs a broadcast to N seeded subscribers for every --subs size and
+    reports messages/sec.
+
+Nothing talks to the real Telegram or Upstash. BROADCAST_RATE defaults to
+unthrottled here (--rate) so the numbers show what the code can push.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import multiprocessing
+
+import httpx
+
+BENCH_TOKEN = "0:bench"
+BENCH_ADMIN = 1
+SEND_METHODS = ("sendMessage", "copyMessage", "sendPhoto", "sendVideo", "sendAnimation")
+
+# ====== Fake servers ======
+# Plain asyncio HTTP/1.1 (keep-alive, Content-Length bodies): the stand-ins
+# should cost next to nothing so the numbers are about the bot.
+_REASONS = {200: b"OK", 403: b"Forbidden", 404: b"Not Found", 429: b"Too Many Requests"}
+
+def http_server(route):
+    """`route(method, path, body) -> (status, json-able)` served over streams."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode("latin-1").split(" ", 2)
+                length = 0
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = h.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await route(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                             % (status, _REASONS.get(status, b"OK"), len(data)) + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+def fake_telegram(opts: dict):
+    counts: dict[str, int] = {}
+    rnd = random.Random(opts["seed"])
+
+    async def route(method: str, path: str, body: bytes):
+        if path.startswith("/_"):
+            return _control(path, counts)
+        name = path.rsplit("/", 1)[-1]
+        counts[name] = counts.get(name, 0) + 1
+        if opts["tg_latency"]:
+            await asyncio.sleep(opts["tg_latency"] / 1000)
+        if name in SEND_METHODS:
+            roll = rnd.random()
+            if roll < opts["p429"]:
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                             "parameters": {"retry_after": opts["retry_after"]}}
+            if roll < opts["p429"] + opts["p403"]:
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if name == "getMe":
+            return 200, {"ok": True, "result": {"id": 0, "is_bot": True, "username": "bench_bot"}}
+        return 200, {"ok": True, "result": {"message_id": 1}}
+
+    return route
+
+def fake_upstash(opts: dict):
+    from main import MemoryStore  # same command set (and Lua twins) as the bot's memory backend
+    store = MemoryStore()
+    counts: dict[str, int] = {}
+
+    def run(cmd: list):
+        try:
+            return {"result": store.call(*cmd)}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def route(method: str, path: str, body: bytes):
+        if path == "/_seed":
+            req = json.loads(body)
+            store.call("DEL", req["key"])
+            start, n = req.get("start", 100000), req["count"]
+            for i in range(start, start + n, 10000):
+                store.call("SADD", req["key"], *range(i, min(i + 10000, start + n)))
+            return 200, {"ok": True}
+        if path.startswith("/_"):
+            return _control(path, counts)
+        cmds = json.loads(body)
+        if opts["redis_latency"]:
+            await asyncio.sleep(opts["redis_latency"] / 1000)
+        if path == "/":
+            name = str(cmds[0]).upper()
+            counts[name] = counts.get(name, 0) + 1
+            return 200, run(cmds)
+        kind = path.strip("/")  # pipeline / multi-exec
+        counts[kind] = counts.get(kind, 0) + 1
+        counts["commands_in_batches"] = counts.get("commands_in_batches", 0) + len(cmds)
+        return 200, [run(c) for c in cmds]
+
+    return route
+
+def _control(path: str, counts: dict):
+    if path == "/_reset":
+        counts.clear()
+        return 200, {"ok": True}
+    if path == "/_stats":
+        return 200, counts
+    return 404, {"ok": False}
+
+def _serve_fakes(opts: dict, conn):
+    async def serve():
+        servers = [await asyncio.start_server(http_server(make(opts)), "127.0.0.1", 0)
+                   for make in (fake_telegram, fake_upstash)]
+        conn.send([srv.sockets[0].getsockname()[1] for srv in servers])
+        await asyncio.gather(*(srv.serve_forever() for srv in servers))
+
+    asyncio.run(serve())
+
+def start_fakes(opts: dict) -> tuple[multiprocessing.Process, str, str]:
+    # Own process, so the fakes don't compete with the bot for the event loop
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_serve_fakes, args=(opts, child), daemon=True)
+    proc.start()
+    tg_port, up_port = parent.recv()
+    return proc, f"http://127.0.0.1:{tg_port}", f"http://127.0.0.1:{up_port}"
+
+# ====== Corpus ======
+CHATTER = ["hi", "hello there", "how to join", "share not counting", "how much", "ok thanks",
+           "what is this", "lol", "support", "change language"]
+COMMANDS = ["/start", "/menu", "/progress", "/top", "/help", "/daily", "/about", "/tip", "/language"]
+CALLBACKS = ["access", "language", "lang:en", "lang:fr", "vote:1:0", "vote:1:1"]
+
+def make_corpus(n: int, users: int, seed: int, mix: tuple[float, float, float]) -> list[dict]:
+    """`mix` = share of (messages, callbacks, join requests)."""
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        uid = 100000 + rnd.randrange(users)
+        kind = rnd.choices(("message", "callback", "join"), weights=mix)[0]
+        u: dict = {"update_id": 10_000_000 + i}
+        if kind == "message":
+            text = rnd.choice(COMMANDS) if rnd.random() < 0.5 else rnd.choice(CHATTER)
+            u["message"] = {"message_id": i, "chat": {"id": uid, "type": "private"},
+                            "from": {"id": uid, "first_name": "U"}, "text": text}
+        elif kind == "callback":
+            u["callback_query"] = {"id": str(i), "from": {"id": uid, "first_name": "U"},
+                                   "message": {"message_id": 1, "chat": {"id": uid}},
+                                   "data": rnd.choice(CALLBACKS)}
+        else:
+            u["chat_join_request"] = {"chat": {"id": -100}, "from": {"id": uid, "first_name": "U"}}
+        out.append(u)
+    return out
+
+# ====== Runs ======
+def pct(sorted_vals: list[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(p / 100 * len(sorted_vals)))]
+
+async def fake_counts(http: httpx.AsyncClient, base: str, reset: bool = False) -> dict:
+    if reset:
+        await http.post(f"{base}/_reset")
+        return {}
+    return (await http.get(f"{base}/_stats")).json()
+
+async def bench_webhook(main, http, tg_base, up_base, corpus: list, concurrency: int, warmup: int) -> dict:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as bot:
+        for u in corpus[:warmup]:
+            await bot.post("/webhook", json=u)
+        if main.WEBHOOK_MODE == "queue":
+            await main._POOL.drain()
+        measured = corpus[warmup:]
+        await fake_counts(http, tg_base, reset=True)
+        await fake_counts(http, up_base, reset=True)
+
+        lat: list[float] = []
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(u):
+            async with sem:
+                t = time.perf_counter()
+                await bot.post("/webhook", json=u)
+                lat.append((time.perf_counter() - t) * 1000)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(u) for u in measured))
+        if main.WEBHOOK_MODE == "queue":
+            await main._POOL.drain()  # the work behind the acks
+        wall = time.perf_counter() - t0
+
+    tg_calls = await fake_counts(http, tg_base)
+    up_calls = await fake_counts(http, up_base)
+    n = max(1, len(measured))
+    up_trips = sum(v for k, v in up_calls.items() if k != "commands_in_batches")
+    lat.sort()
+    return {
+        "updates": len(measured),
+        "concurrency": concurrency,
+        "p50_ms": round(pct(lat, 50), 2),
+        "p95_ms": round(pct(lat, 95), 2),
+        "p99_ms": round(pct(lat, 99), 2),
+        "updates_per_sec": round(len(measured) / wall, 1),
+        "tg_calls_per_update": round(sum(tg_calls.values()) / n, 3),
+        "redis_round_trips_per_update": round(up_trips / n, 3),
+        "tg_calls": tg_calls,
+        "redis_calls": up_calls,
+    }
+
+async def seed_subs(main, http, up_base, n: int):
+    if isinstance(main.STORE, main.MemoryStore):
+        main.STORE.call("DEL", "subs")
+        for i in range(100000, 100000 + n, 10000):
+            main.STORE.call("SADD", "subs", *range(i, min(i + 10000, 100000 + n)))
+    else:
+        await http.post(f"{up_base}/_seed", json={"key": "subs", "count": n}, timeout=None)
+
+async def bench_broadcast(main, http, tg_base, up_base, subs: int) -> dict:
+    await seed_subs(main, http, up_base, subs)
+    await fake_counts(http, tg_base, reset=True)
+    spec = {"kind": "message", "payload": {"text": "bench broadcast", "disable_web_page_preview": True}}
+    t0 = time.perf_counter()
+    await main.start_broadcast(BENCH_ADMIN, spec, "sent {n}")
+    wall = time.perf_counter() - t0
+    tg_calls = await fake_counts(http, tg_base)
+    sends = tg_calls.get("sendMessage", 0) - 1  # minus the admin report
+    return {
+        "subscribers": subs,
+        "seconds": round(wall, 2),
+        "messages_per_sec": round(sends / wall, 1) if wall else 0.0,
+        "send_attempts": sends,
+    }
+
+def _print_webhook(r: dict):
+    print(f"webhook  n={r['updates']} c={r['concurrency']}  "
+          f"p50={r['p50_ms']}ms p95={r['p95_ms']}ms p99={r['p99_ms']}ms  "
+          f"{r['updates_per_sec']} upd/s  "
+          f"tg/upd={r['tg_calls_per_update']} redis/upd={r['redis_round_trips_per_update']}")
+
+def _print_broadcast(r: dict):
+    print(f"broadcast subs={r['subscribers']}  {r['seconds']}s  {r['messages_per_sec']} msg/s")
+
+async def run(args, tg_base: str, up_base: str) -> dict:
+    import main  # after the env points it at the fakes
+
+    corpus = make_corpus(args.updates + args.warmup, args.users, args.seed,
+                         tuple(float(x) for x in args.mix.split(",")))
+    results: dict = {"webhook": None, "broadcast": []}
+    async with httpx.AsyncClient(timeout=60) as http, main.lifespan(main.app):
+        await main.create_poll("bench?", ["a", "b"])  # poll 1 for the vote callbacks
+        if args.updates:
+            results["webhook"] = await bench_webhook(main, http, tg_base, up_base, corpus,
+                                                     args.concurrency, args.warmup)
+            _print_webhook(results["webhook"])
+        for n in args.subs:
+            r = await bench_broadcast(main, http, tg_base, up_base, n)
+            results["broadcast"].append(r)
+            _print_broadcast(r)
+    results["stats"] = dict(main.STATS)
+    return results
+
+def main_cli():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--updates", type=int, default=5000, help="measured webhook updates (0 = skip)")
+    p.add_argument("--warmup", type=int, default=200)
+    p.add_argument("--users", type=int, default=5000, help="distinct user ids in the corpus")
+    p.add_argument("--mix", default="0.7,0.2,0.1", help="messages,callbacks,join requests")
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--subs", default="10000", help="comma-separated broadcast sizes (empty = skip)")
+    p.add_argument("--rate", default="1000000", help="BROADCAST_RATE for the run")
+    p.add_argument("--mode", default="inline", choices=("inline", "queue"), help="WEBHOOK_MODE")
+    p.add_argument("--store", default="upstash", choices=("upstash", "memory"),
+                   help="upstash = through the fake REST server, memory = in-process")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="ms added to every Bot API call")
+    p.add_argument("--redis-latency", type=float, default=0.0, help="ms added to every Upstash call")
+    p.add_argument("--p429", type=float, default=0.0, help="share of sends answered with 429")
+    p.add_argument("--p403", type=float, default=0.0, help="share of sends answered with 403")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="also write the results to this file")
+    args = p.parse_args()
+    args.subs = [int(x) for x in args.subs.split(",") if x.strip()]
+
+    opts = {"tg_latency": args.tg_latency, "redis_latency": args.redis_latency, "p429": args.p429,
+            "p403": args.p403, "retry_after": args.retry_after, "seed": args.seed}
+    proc, tg_base, up_base = start_fakes(opts)
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "ADMIN_ID": str(BENCH_ADMIN),
+        "TG_API_BASE": tg_base,
+        "UPSTASH_REDIS_REST_URL": up_base,
+        "UPSTASH_REDIS_REST_TOKEN": "bench",
+        "STORAGE_BACKEND": args.store,
+        "REDIS_URL": "",
+        "WEBHOOK_MODE": args.mode,
+        "BROADCAST_RATE": args.rate,
+        "BROADCAST_SHARDED": "0",
+    })
+    try:
+        results = asyncio.run(run(args, tg_base, up_base))
+    finally:
+        proc.terminate()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,28 +1,105 @@
 import os
+import re
+import json
+import time
+import hmac
+import hashlib
 import asyncio
-from urllib.parse import quote, quote_plus
+import logging
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from urllib.parse import quote_plus
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 import httpx
 import random
 
-app = FastAPI()
-
 # ====== ENV ======
 BOT_TOKEN   = os.getenv("BOT_TOKEN", "")
 IMAGE_URL   = os.getenv("IMAGE_URL", "")
 SHARE_URL   = os.getenv("SHARE_URL", "")
+BOT_USERNAME = os.getenv("BOT_USERNAME", "").lstrip("@")  # for referral deep links; looked up via getMe if unset
 CHANNEL_URL = os.getenv("CHANNEL_URL", "")
 GOAL        = int(os.getenv("GOAL", "6"))
 ADMIN_ID    = int(os.getenv("ADMIN_ID", "0"))
 # Media for UI (photo/gif/video)
 UI_MEDIA_URL  = os.getenv("UI_MEDIA_URL", "")
 UI_MEDIA_TYPE = (os.getenv("UI_MEDIA_TYPE", "") or "").lower()  # "", "photo", "gif", "video"
+MEDIA_PREWARM = os.getenv("MEDIA_PREWARM", "1") == "1"  # upload the UI media to ADMIN_ID at startup to learn its file_id
 
 # Upstash REST (READ/WRITE tokens, not redis://)
 UPSTASH_URL   = os.getenv("UPSTASH_REDIS_REST_URL", "").rstrip("/")
 UPSTASH_TOKEN = os.getenv("UPSTASH_REDIS_REST_TOKEN", "")
-
-TG_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+# Storage: "upstash" (REST), "redis" (native redis:// pool) or "memory" (in-process,
+# tests/benchmarks). Unset = "redis" when REDIS_URL is set, else "upstash".
+STORAGE_BACKEND = (os.getenv("STORAGE_BACKEND", "") or "").lower()
+REDIS_URL       = os.getenv("REDIS_URL", "")
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "32"))
+
+TG_API_BASE = os.getenv("TG_API_BASE", "https://api.telegram.org").rstrip("/")  # override for a local fake
+TG_API = f"{TG_API_BASE}/bot{BOT_TOKEN}"
+
+log = logging.getLogger("gainaccess")
+
+# Webhook processing: "inline" handles the update before answering Telegram,
+# "queue" acks immediately and hands the update to a pool of workers.
+WEBHOOK_MODE      = (os.getenv("WEBHOOK_MODE", "inline") or "inline").lower()
+UPDATE_WORKERS    = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # total, split across workers
+# Inline mode only: return an update's first reply as the webhook response body
+# (Bot API "method" reply) instead of making a separate outbound call.
+WEBHOOK_REPLY     = os.getenv("WEBHOOK_REPLY", "0") == "1"
+# Admission control: at most ADMIT_MAX_INFLIGHT webhook requests in flight (0 = no cap).
+# When full, lanes wait this long for a slot before being shed:
+# callbacks/join requests, commands, chatter.
+ADMIT_MAX_INFLIGHT = int(os.getenv("ADMIT_MAX_INFLIGHT", "64"))
+ADMIT_WAIT_SECS    = tuple(float(x) for x in os.getenv("ADMIT_WAIT_SECS", "3,1,0").split(","))
+# Independent steps of one handler run concurrently; one still going after this is cancelled
+STEP_TIMEOUT_SECS  = float(os.getenv("STEP_TIMEOUT_SECS", "10"))
+
+# HTTP connection pools (one long-lived client per upstream host)
+HTTP2          = os.getenv("HTTP2", "0") == "1"           # needs `pip install httpx[http2]`
+HTTP_MAX_CONN  = int(os.getenv("HTTP_MAX_CONN", "100"))
+HTTP_KEEPALIVE = int(os.getenv("HTTP_KEEPALIVE", "20"))   # idle connections kept per pool
+HTTP_IDLE_SECS = float(os.getenv("HTTP_IDLE_SECS", "30"))
+TG_TIMEOUT     = float(os.getenv("TG_TIMEOUT", "20"))
+REDIS_TIMEOUT  = float(os.getenv("REDIS_TIMEOUT", "15"))
+
+# Broadcasts (Telegram allows ~30 msg/s across different chats)
+BROADCAST_RATE        = float(os.getenv("BROADCAST_RATE", "30"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_RETRIES     = int(os.getenv("BROADCAST_RETRIES", "3"))     # retries after a 429
+
+SCAN_COUNT            = int(os.getenv("SCAN_COUNT", "500"))  # SSCAN page size hint for subscriber scans
+LEASE_TTL_MS          = int(os.getenv("LEASE_TTL_MS", "30000"))  # broadcast lock lease, renewed every ttl/3
+# Sharded broadcasts: every worker claims pages of a job from Redis
+BROADCAST_SHARDED     = os.getenv("BROADCAST_SHARDED", "0") == "1"
+SHARD_POLL_SECS       = float(os.getenv("SHARD_POLL_SECS", "2"))
+SHARD_CLAIM_SECS      = int(os.getenv("SHARD_CLAIM_SECS", "120"))  # an unrenewed claim returns to the queue after this
+SHARD_PAGE_SECS       = float(os.getenv("SHARD_PAGE_SECS", "10"))  # work item = ids sent in this long at BROADCAST_RATE
+
+# Referral leaderboard
+TOP_K         = int(os.getenv("TOP_K", "10"))
+TOP_CACHE_TTL = float(os.getenv("TOP_CACHE_TTL", "30"))  # seconds a /top snapshot is reused
+
+# Update de-duplication
+DEDUPE_TTL      = int(os.getenv("DEDUPE_TTL", "86400"))     # seconds a seen_update:* key lives
+DEDUPE_LRU_SIZE = int(os.getenv("DEDUPE_LRU_SIZE", "10000"))  # update_ids remembered in-process
+
+# Per-user language cache
+LANG_CACHE_SIZE = int(os.getenv("LANG_CACHE_SIZE", "50000"))
+LANG_CACHE_TTL  = int(os.getenv("LANG_CACHE_TTL", "600"))
+
+# Admin-set config (channel, daily teaser)
+CONFIG_REFRESH_SECS = float(os.getenv("CONFIG_REFRESH_SECS", "5"))  # how often other workers' changes are picked up
+
+# Per-update tracing: every Redis/Telegram call an update makes, with timings
+TRACE_SAMPLE   = float(os.getenv("TRACE_SAMPLE", "0"))      # share of updates kept in the /debug/traces ring
+TRACE_BUFFER   = int(os.getenv("TRACE_BUFFER", "200"))      # traces kept per ring (sampled, slow)
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "2000"))  # log + keep updates slower than this; 0 = off
+DEBUG_TOKEN    = os.getenv("DEBUG_TOKEN", "")               # required for /debug/traces; unset = endpoint off
 
 # ====== i18n ======
 LANGS = {
@@ -185,74 +262,881 @@ LANGS = {
     },
 }
 DEFAULT_LANG = "en"
-_LANG_CACHE: dict[int, str] = {}
+
+# ====== Caches + stats ======
+class LRUCache:
+    """Size-bounded LRU mapping with an optional TTL (seconds) per entry."""
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def add(self, key, value=True) -> bool:
+        # set-if-absent; False when the key is already cached
+        if key in self:
+            return False
+        self.set(key, value)
+        return True
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+_MISSING = object()
+
+STATS: dict[str, int] = {}
+
+def stat(name: str, n: int = 1):
+    STATS[name] = STATS.get(name, 0) + n
+
+# Latency histograms for /metrics: fixed buckets, one row of counts per label
+# value, so observe() is a bisect and two additions.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Prometheus histogram with a single label."""
+
+    def __init__(self, name: str, help: str, label: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._rows: dict[str, list] = {}  # label value -> [count per bucket..., +Inf, sum]
+
+    def observe(self, value: str, secs: float):
+        row = self._rows.get(value)
+        if row is None:
+            row = self._rows[value] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect_left(self.buckets, secs)] += 1
+        row[-1] += secs
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, row in sorted(self._rows.items()):
+            lbl = f'{self.label}="{value}"'
+            total = 0
+            for le, c in zip(self.buckets + ("+Inf",), row):
+                total += c
+                lines.append(f'{self.name}_bucket{{{lbl},le="{le}"}} {total}')
+            lines.append(f"{self.name}_sum{{{lbl}}} {row[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{lbl}}} {total}")
+        return lines
+
+TG_SECONDS = Histogram("gainaccess_telegram_request_seconds", "Bot API call latency by method.", "method")
+REDIS_SECONDS = Histogram("gainaccess_redis_command_seconds", "Storage round trip latency by command (batches as pipeline/multi).", "command")
+UPDATE_SECONDS = Histogram("gainaccess_update_seconds", "Time to handle one update by type.", "type")
+TG_ERRORS: dict[str, int] = {}  # Bot API error_code (or "transport") -> count
+INFLIGHT = {"updates": 0, "broadcasts": 0}
+
+# Tracing: handle_update() puts a span list in _TRACE; _tg/r_cmd/RedisBatch append
+# (kind, name, start, secs, status) to it. With tracing off the var stays None
+# and each call pays one ContextVar lookup.
+_TRACE: ContextVar[list | None] = ContextVar("trace", default=None)
+_TRACING = TRACE_SAMPLE > 0 or SLOW_UPDATE_MS > 0
+SAMPLED_TRACES: deque = deque(maxlen=TRACE_BUFFER)
+SLOW_TRACES: deque = deque(maxlen=TRACE_BUFFER)
+
+def trace_span(kind: str, name: str, start: float, end: float, status):
+    spans = _TRACE.get()
+    if spans is not None:
+        spans.append((kind, name, start, end - start, status))
+
+_SEEN_UPDATES = LRUCache(DEDUPE_LRU_SIZE, ttl=DEDUPE_TTL)
+# uid -> lang code. Trusted on the hot path; the TTL bounds how long another
+# worker's /lang change can take to show up here.
+_LANG_CACHE = LRUCache(LANG_CACHE_SIZE, ttl=LANG_CACHE_TTL)
+
+# ====== HTTP clients ======
+_CLIENTS: dict[str, httpx.AsyncClient] = {}
+
+def _http2_available() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _client(name: str, timeout: float) -> httpx.AsyncClient:
+    # Created lazily so helpers also work outside the app lifespan (scripts, shell)
+    c = _CLIENTS.get(name)
+    if c is None or c.is_closed:
+        c = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 5.0)),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONN,
+                max_keepalive_connections=HTTP_KEEPALIVE,
+                keepalive_expiry=HTTP_IDLE_SECS,
+            ),
+            http2=_http2_available(),
+        )
+        _CLIENTS[name] = c
+    return c
+
+def tg_client() -> httpx.AsyncClient:
+    return _client("telegram", TG_TIMEOUT)
+
+def redis_client() -> httpx.AsyncClient:
+    return _client("upstash", REDIS_TIMEOUT)
+
+async def close_clients():
+    clients = list(_CLIENTS.values())
+    _CLIENTS.clear()
+    for c in clients:
+        try:
+            await c.aclose()
+        except Exception:
+            pass
 
 # ====== Upstash REST helpers ======
 def _auth():
     return {"Authorization": f"Bearer {UPSTASH_TOKEN}"} if UPSTASH_TOKEN else {}
 
-def enc(v) -> str:
-    return quote(str(v), safe="")
-
-async def _req(method: str, path: str):
+async def _req_json(path: str, body):
     if not UPSTASH_URL or not UPSTASH_TOKEN:
         return None
-    url = f"{UPSTASH_URL}/{path}"
+    url = f"{UPSTASH_URL}/{path}" if path else UPSTASH_URL
     try:
-        async with httpx.AsyncClient(timeout=15) as c:
-            r = await c.request(method, url, headers=_auth())
-            return r.json()
+        r = await redis_client().post(url, headers=_auth(), json=body)
+        return r.json()
     except Exception:
         return None
 
+# ====== Storage backends ======
+# Every backend answers commands as string lists (["SET", "k", "v"]) with the
+# replies Upstash would give: strings, ints, lists, None on error. `batch()`
+# returns one reply per command, or None when the whole round trip failed.
+class UpstashStore:
+    name = "upstash"
+
+    @property
+    def configured(self) -> bool:
+        return bool(UPSTASH_URL and UPSTASH_TOKEN)
+
+    async def command(self, args: list[str]):
+        data = await _req_json("", args)
+        if not isinstance(data, dict) or "error" in data:
+            stat("redis_error")
+            return None
+        return data.get("result")
+
+    async def batch(self, cmds: list[list[str]], atomic: bool = False) -> list | None:
+        data = await _req_json("multi-exec" if atomic else "pipeline", cmds)
+        if not isinstance(data, list):
+            stat("redis_error")
+            return None
+        n = len(cmds)
+        out = [d.get("result") if isinstance(d, dict) else None for d in data[:n]]
+        return out + [None] * (n - len(out))
+
+    async def open(self):
+        redis_client()
+
+    async def close(self):
+        pass  # the httpx client goes with close_clients()
+
+class NativeRedisStore:
+    """redis:// over a pooled RESP connection (redis-py asyncio)."""
+    name = "redis"
+
+    def __init__(self, url: str, pool_size: int = REDIS_POOL_SIZE):
+        self.url = url
+        self.pool_size = pool_size
+        self._r = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.url)
+
+    def _conn(self):
+        if self._r is None:
+            import redis.asyncio as aioredis
+            pool = aioredis.BlockingConnectionPool.from_url(
+                self.url,
+                max_connections=self.pool_size,
+                timeout=REDIS_TIMEOUT,
+                socket_timeout=REDIS_TIMEOUT,
+                socket_connect_timeout=min(REDIS_TIMEOUT, 5.0),
+                health_check_interval=30,
+                decode_responses=True,
+            )
+            self._r = aioredis.Redis(connection_pool=pool)
+            # Raw replies, same shapes as Upstash (no dict/bool/float conversions)
+            self._r.response_callbacks.clear()
+        return self._r
+
+    async def command(self, args: list[str]):
+        if not self.url:
+            return None
+        try:
+            return await self._conn().execute_command(*args)
+        except Exception:
+            stat("redis_error")
+            return None
+
+    async def batch(self, cmds: list[list[str]], atomic: bool = False) -> list | None:
+        if not self.url:
+            return None
+        try:
+            pipe = self._conn().pipeline(transaction=atomic)
+            for c in cmds:
+                pipe.execute_command(*c)
+            res = await pipe.execute(raise_on_error=False)
+        except Exception:
+            stat("redis_error")
+            return None
+        return [None if isinstance(r, Exception) else r for r in res]
+
+    async def open(self):
+        if self.url:
+            await self.command(["PING"])
+
+    async def close(self):
+        r, self._r = self._r, None
+        if r is not None:
+            try:
+                await r.aclose()
+            except Exception:
+                pass
+
+class MemoryStore:
+    """In-process store for tests, benchmarks and single-worker dev runs.
+
+    Implements the command subset this bot uses. Lua scripts run as the Python
+    twins registered next to them with `@MemoryStore.script(lua)`.
+    """
+    name = "memory"
+    configured = True
+    SCRIPTS: dict = {}
+
+    @classmethod
+    def script(cls, lua: str):
+        def deco(fn):
+            cls.SCRIPTS[lua] = fn
+            return fn
+        return deco
+
+    def __init__(self):
+        self.data: dict = {}
+        self._exp: dict[str, float] = {}
+        self._scan: dict[str, list] = {}  # key -> sorted members, dropped on any change
+
+    def _changed(self, key: str):
+        self._scan.pop(key, None)
+
+    def _get(self, key: str, kind=None):
+        exp = self._exp.get(key)
+        if exp is not None and exp <= time.monotonic():
+            self.data.pop(key, None)
+            self._exp.pop(key, None)
+            self._changed(key)
+        v = self.data.get(key)
+        if v is not None and kind is not None and not isinstance(v, kind):
+            raise TypeError("WRONGTYPE")
+        return v
+
+    def _new(self, key: str, kind):
+        v = self._get(key, kind)
+        if v is None:
+            v = self.data[key] = kind()
+        return v
+
+    def call(self, *args):
+        op, a = str(args[0]).lower(), [str(x) for x in args[1:]]
+        fn = getattr(self, f"_c_{op}", None)
+        if fn is None:
+            raise ValueError(f"unsupported command {op}")
+        return fn(*a)
+
+    async def command(self, args: list[str]):
+        try:
+            return self.call(*args)
+        except Exception:
+            return None
+
+    async def batch(self, cmds: list[list[str]], atomic: bool = False) -> list | None:
+        # Nothing awaits in between, so every batch is atomic here
+        out = []
+        for c in cmds:
+            try:
+                out.append(self.call(*c))
+            except Exception:
+                out.append(None)
+        return out
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # strings + keys
+    def _c_ping(self):
+        return "PONG"
+
+    def _c_get(self, k):
+        return self._get(k, str)
+
+    def _c_mget(self, *keys):
+        return [v if isinstance(v, str) else None for v in map(self._get, keys)]
+
+    def _c_set(self, k, v, *opts):
+        up = [o.upper() for o in opts]
+        if "NX" in up and self._get(k) is not None:
+            return None
+        self.data[k] = v
+        self._changed(k)
+        self._exp.pop(k, None)
+        if "EX" in up:
+            self._exp[k] = time.monotonic() + int(opts[up.index("EX") + 1])
+        if "PX" in up:
+            self._exp[k] = time.monotonic() + int(opts[up.index("PX") + 1]) / 1000
+        return "OK"
+
+    def _c_del(self, *keys):
+        n = 0
+        for k in keys:
+            if self._get(k) is not None:
+                del self.data[k]
+                self._exp.pop(k, None)
+                self._changed(k)
+                n += 1
+        return n
+
+    def _c_incrby(self, k, n):
+        v = int(self._get(k, str) or 0) + int(n)
+        self.data[k] = str(v)
+        return v
+
+    def _c_incr(self, k):
+        return self._c_incrby(k, 1)
+
+    def _c_pexpire(self, k, ms):
+        if self._get(k) is None:
+            return 0
+        self._exp[k] = time.monotonic() + int(ms) / 1000
+        return 1
+
+    def _c_expire(self, k, secs):
+        return self._c_pexpire(k, int(secs) * 1000)
+
+    def _c_pttl(self, k):
+        if self._get(k) is None:
+            return -2
+        exp = self._exp.get(k)
+        return -1 if exp is None else int((exp - time.monotonic()) * 1000)
+
+    # sets
+    def _c_sadd(self, k, *members):
+        s = self._new(k, set)
+        n = len(s)
+        s.update(members)
+        self._changed(k)
+        return len(s) - n
+
+    def _c_srem(self, k, *members):
+        s = self._get(k, set) or set()
+        n = len(s)
+        s.difference_update(members)
+        self._changed(k)
+        return n - len(s)
+
+    def _c_smembers(self, k):
+        return list(self._get(k, set) or ())
+
+    def _c_scard(self, k):
+        return len(self._get(k, set) or ())
+
+    def _c_sscan(self, k, cursor, *opts):
+        # Cursor = ">" + last member returned, so SREMs mid-scan can't shift
+        # live members past it (an offset would). Sorted once per version of the set.
+        items = self._scan.get(k)
+        if items is None:
+            items = self._scan[k] = sorted(self._get(k, set) or ())
+        up = [o.upper() for o in opts]
+        count = int(opts[up.index("COUNT") + 1]) if "COUNT" in up else 10
+        cursor = str(cursor)
+        start = bisect_right(items, cursor[1:]) if cursor.startswith(">") else 0
+        page = items[start:start + count]
+        return ["0" if start + count >= len(items) else ">" + page[-1], page]
+
+    # hashes
+    def _c_hset(self, k, *fv):
+        h = self._new(k, dict)
+        n = 0
+        for i in range(0, len(fv) - 1, 2):
+            n += fv[i] not in h
+            h[fv[i]] = fv[i + 1]
+        return n
+
+    def _c_hsetnx(self, k, f, v):
+        h = self._new(k, dict)
+        if f in h:
+            return 0
+        h[f] = v
+        return 1
+
+    def _c_hget(self, k, f):
+        return (self._get(k, dict) or {}).get(f)
+
+    def _c_hmget(self, k, *fields):
+        h = self._get(k, dict) or {}
+        return [h.get(f) for f in fields]
+
+    def _c_hdel(self, k, *fields):
+        h = self._get(k, dict) or {}
+        return sum(h.pop(f, None) is not None for f in fields)
+
+    def _c_hincrby(self, k, f, n):
+        h = self._new(k, dict)
+        v = int(h.get(f, 0)) + int(n)
+        h[f] = str(v)
+        return v
+
+    def _c_hgetall(self, k):
+        out = []
+        for f, v in (self._get(k, dict) or {}).items():
+            out += [f, v]
+        return out
+
+    # sorted sets (dict member -> float score)
+    def _c_zincrby(self, k, inc, m):
+        z = self._new(k, dict)
+        z[m] = z.get(m, 0.0) + float(inc)
+        return f"{z[m]:.17g}"
+
+    def _c_zscore(self, k, m):
+        v = (self._get(k, dict) or {}).get(m)
+        return None if v is None else f"{v:.17g}"
+
+    def _c_zrevrange(self, k, start, stop, *opts):
+        ranked = sorted((self._get(k, dict) or {}).items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+        start, stop = int(start), int(stop)
+        stop = len(ranked) + stop if stop < 0 else stop
+        out = []
+        for m, v in ranked[start:stop + 1]:
+            out += [m, f"{v:.17g}"] if "WITHSCORES" in [o.upper() for o in opts] else [m]
+        return out
+
+    # lists
+    def _c_rpush(self, k, *vals):
+        lst = self._new(k, list)
+        lst.extend(vals)
+        return len(lst)
+
+    def _c_lpop(self, k):
+        lst = self._get(k, list)
+        return lst.pop(0) if lst else None
+
+    def _c_eval(self, script, numkeys, *rest):
+        n = int(numkeys)
+        return self.SCRIPTS[script](self.call, list(rest[:n]), list(rest[n:]))
+
+def make_store(kind: str = STORAGE_BACKEND):
+    if kind == "memory":
+        return MemoryStore()
+    if kind == "redis" or (not kind and REDIS_URL):
+        return NativeRedisStore(REDIS_URL)
+    return UpstashStore()
+
+STORE = make_store()
+
+# ====== Storage helpers ======
+async def r_cmd(*args):
+    # Single command, e.g. r_cmd("SET", "k", "v", "EX", 60)
+    t = time.perf_counter()
+    res = await STORE.command([str(a) for a in args])
+    t1 = time.perf_counter()
+    name = str(args[0]).upper()
+    REDIS_SECONDS.observe(name, t1 - t)
+    trace_span("redis", name, t, t1, "ok" if res is not None else "nil")
+    return res
+
+class RedisBatch:
+    """Collects commands and sends them to the store in one round trip.
+
+    `add()` returns the index of the command's result in the list returned
+    by `run()`. Atomic batches run as MULTI/EXEC (Upstash /multi-exec), the
+    rest as a plain pipeline. Failed commands (or a failed request) come
+    back as None.
+    """
+
+    def __init__(self, atomic: bool = False):
+        self.atomic = atomic
+        self.ok = False  # True once the store answered the batch
+        self._cmds: list[list[str]] = []
+
+    def __len__(self) -> int:
+        return len(self._cmds)
+
+    def add(self, *args) -> int:
+        self._cmds.append([str(a) for a in args])
+        return len(self._cmds) - 1
+
+    async def run(self) -> list:
+        n = len(self._cmds)
+        if not n:
+            return []
+        t = time.perf_counter()
+        out = await STORE.batch(self._cmds, self.atomic)
+        t1 = time.perf_counter()
+        name = "multi" if self.atomic else "pipeline"
+        REDIS_SECONDS.observe(name, t1 - t)
+        ops = " ".join(c[0] for c in self._cmds[:8]) + (" …" if len(self._cmds) > 8 else "")
+        trace_span("redis", f"{name}[{ops}]", t, t1, "ok" if out is not None else "error")
+        if out is None:
+            return [None] * n
+        self.ok = True
+        return out
+
 async def r_sadd(key: str, member: str | int):
     # no return (kept for backward compatibility)
-    await _req("POST", f"sadd/{enc(key)}/{enc(member)}")
+    await r_cmd("SADD", key, member)
 
 async def r_sadd_res(key: str, member: str | int) -> int:
-    data = await _req("POST", f"sadd/{enc(key)}/{enc(member)}")
-    try:
-        return int(data.get("result", 0)) if isinstance(data, dict) else 0
-    except Exception:
-        return 0
+    res = await r_cmd("SADD", key, member)
+    return res if isinstance(res, int) else 0
 
 async def r_smembers(key: str) -> list[str]:
-    data = await _req("GET", f"smembers/{enc(key)}")
-    return data.get("result", []) if isinstance(data, dict) else []
+    res = await r_cmd("SMEMBERS", key)
+    return res if isinstance(res, list) else []
+
+async def r_sscan_pages(key: str, count: int = SCAN_COUNT, cursor: str = "0"):
+    """Async iterator of (next_cursor, members) pages over a set via SSCAN.
+
+    Pages stream as they arrive, so callers can start working after the
+    first one. Stops at cursor "0" or on a store error.
+    """
+    while True:
+        data = await r_cmd("SSCAN", key, cursor, "COUNT", count)
+        if not isinstance(data, list) or len(data) != 2:
+            return
+        cursor, members = str(data[0]), data[1] or []
+        yield cursor, members
+        if cursor == "0":
+            return
 
 async def r_set(key: str, value: str):
-    await _req("POST", f"set/{enc(key)}/{enc(value)}")
+    await r_cmd("SET", key, value)
 
 async def r_get(key: str) -> str | None:
-    data = await _req("GET", f"get/{enc(key)}")
-    return data.get("result") if isinstance(data, dict) else None
+    return await r_cmd("GET", key)
 
 async def r_del(key: str):
-    await _req("POST", f"del/{enc(key)}")
+    await r_cmd("DEL", key)
 
 async def r_hincrby(key: str, field: str, amt: int) -> int:
-    data = await _req("POST", f"hincrby/{enc(key)}/{enc(field)}/{amt}")
-    try:
-        return int(data.get("result", 0)) if isinstance(data, dict) else 0
-    except Exception:
-        return 0
+    res = await r_cmd("HINCRBY", key, field, amt)
+    return res if isinstance(res, int) else 0
 
 async def r_hgetall(key: str) -> dict:
-    data = await _req("GET", f"hgetall/{enc(key)}")
-    arr = data.get("result", []) if isinstance(data, dict) else []
+    arr = await r_cmd("HGETALL", key)
     return {arr[i]: arr[i+1] for i in range(0, len(arr), 2)} if isinstance(arr, list) else {}
 
 async def r_hset(key: str, field: str, value: str | int):
-    await _req("POST", f"hset/{enc(key)}/{enc(field)}/{enc(value)}")
+    await r_cmd("HSET", key, field, value)
+
+async def r_eval(script: str, keys: list, args: list):
+    return await r_cmd("EVAL", script, len(keys), *keys, *args)
+
+# ====== Polls ======
+# poll:{pid}        hash: q, opts ("a|b|c"), n (option count), c:<i> (votes for option i)
+# poll:{pid}:votes  hash: uid -> option index (so a changed vote can move its count)
+# Polls sent before the tallies existed (poll:{pid}:q / :opts strings) are
+# converted by _MIGRATE_POLL_LUA the first time they're voted on or read.
+_VOTE_LUA = """
+local n = tonumber(redis.call('HGET', KEYS[1], 'n') or '0')
+local idx = tonumber(ARGV[2])
+if not idx or idx < 0 or idx >= n then return -1 end
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old == ARGV[2] then return 0 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+if old then redis.call('HINCRBY', KEYS[1], 'c:' .. old, -1) end
+redis.call('HINCRBY', KEYS[1], 'c:' .. ARGV[2], 1)
+return 1
+"""
+
+@MemoryStore.script(_VOTE_LUA)
+def _vote_mem(r, keys, argv):
+    n = int(r("HGET", keys[0], "n") or 0)
+    idx = int(argv[1]) if argv[1].lstrip("-").isdigit() else -1
+    if idx < 0 or idx >= n:
+        return -1
+    old = r("HGET", keys[1], argv[0])
+    if old == argv[1]:
+        return 0
+    r("HSET", keys[1], argv[0], argv[1])
+    if old is not None:
+        r("HINCRBY", keys[0], f"c:{old}", -1)
+    r("HINCRBY", keys[0], f"c:{argv[1]}", 1)
+    return 1
+
+_MIGRATE_POLL_LUA = """
+if redis.call('HEXISTS', KEYS[1], 'n') == 1 then return 0 end
+local opts = redis.call('GET', KEYS[3])
+if not opts then return -1 end
+local n = 0
+for _ in string.gmatch(opts .. '|', '([^|]*)|') do n = n + 1 end
+local counts = {}
+local votes = redis.call('HGETALL', KEYS[4])
+for j = 2, #votes, 2 do
+  local i = tonumber(votes[j])
+  if i and i >= 0 and i < n then counts[i] = (counts[i] or 0) + 1 end
+end
+redis.call('HSET', KEYS[1], 'q', redis.call('GET', KEYS[2]) or '', 'opts', opts, 'n', n)
+for i = 0, n - 1 do redis.call('HSET', KEYS[1], 'c:' .. i, counts[i] or 0) end
+redis.call('DEL', KEYS[2], KEYS[3])
+return 1
+"""
+
+@MemoryStore.script(_MIGRATE_POLL_LUA)
+def _migrate_poll_mem(r, keys, argv):
+    if r("HGET", keys[0], "n") is not None:
+        return 0
+    opts = r("GET", keys[2])
+    if opts is None:
+        return -1
+    n = len(opts.split("|"))
+    counts = [0] * n
+    votes = r("HGETALL", keys[3])
+    for v in votes[1::2]:
+        if v.isdigit() and int(v) < n:
+            counts[int(v)] += 1
+    r("HSET", keys[0], "q", r("GET", keys[1]) or "", "opts", opts, "n", n)
+    for i, c in enumerate(counts):
+        r("HSET", keys[0], f"c:{i}", c)
+    r("DEL", keys[1], keys[2])
+    return 1
+
+async def migrate_poll(pid: str) -> bool:
+    """Convert an old-layout poll in place; True if there was one to convert."""
+    keys = [f"poll:{pid}", f"poll:{pid}:q", f"poll:{pid}:opts", f"poll:{pid}:votes"]
+    res = await r_eval(_MIGRATE_POLL_LUA, keys, [])
+    if res == 1:
+        stat("poll_migrated")
+    return res == 1
+
+async def create_poll(q: str, opts: list[str]) -> str:
+    poll_id = str(await r_hincrby("counters", "poll", 1))
+    fields = ["q", q, "opts", "|".join(opts), "n", len(opts)]
+    for i in range(len(opts)):
+        fields += [f"c:{i}", 0]
+    await r_cmd("HSET", f"poll:{poll_id}", *fields)
+    return poll_id
+
+async def record_vote(pid: str, uid: int, idx: str) -> int:
+    """1 = counted, 0 = same vote again, -1 = unknown poll/option."""
+    keys = [f"poll:{pid}", f"poll:{pid}:votes"]
+    res = await r_eval(_VOTE_LUA, keys, [uid, idx])
+    if res == -1 and await migrate_poll(pid):
+        res = await r_eval(_VOTE_LUA, keys, [uid, idx])
+    return res if isinstance(res, int) else -1
+
+async def poll_results(pid: str) -> tuple[str, list[tuple[str, int]]] | None:
+    # One O(options) read; the tallies are kept up to date by record_vote()
+    h = await r_hgetall(f"poll:{pid}")
+    if not h and await migrate_poll(pid):
+        h = await r_hgetall(f"poll:{pid}")
+    if not h:
+        return None
+    opts = (h.get("opts") or "").split("|")
+    return h.get("q") or "", [(o, _score(h.get(f"c:{i}"))) for i, o in enumerate(opts) if o]
+
+# ====== Referrals + leaderboard ======
+# "shares" is a sorted set: member = referrer uid, score = credited joins.
+# The only way in is the share link's /start ref_<uid> (see share_link, cmd_start).
+_TOP_SNAPSHOT: list = [0.0, []]  # [expires_at, [(uid, score), ...]]
+
+async def credit_referral(ref: str, uid: int) -> bool:
+    """Credit `ref` ("ref_<uid>") with one share for a newly joined `uid`."""
+    if not ref.startswith("ref_"):
+        return False
+    try:
+        rid = int(ref[4:])
+    except ValueError:
+        return False
+    if rid == uid:
+        return False
+    await r_cmd("ZINCRBY", "shares", 1, rid)
+    stat("referral_credited")
+    return True
+
+def _score(val) -> int:
+    try:
+        return int(float(val or 0))
+    except (TypeError, ValueError):
+        return 0
+
+async def top_shares(k: int = TOP_K) -> list[tuple[str, int]]:
+    # Everyone asking /top within TOP_CACHE_TTL shares one ZREVRANGE
+    now = time.monotonic()
+    if _TOP_SNAPSHOT[0] > now:
+        return _TOP_SNAPSHOT[1]
+    arr = await r_cmd("ZREVRANGE", "shares", 0, k - 1, "WITHSCORES")
+    pairs = []
+    if isinstance(arr, list):
+        pairs = [(arr[i], _score(arr[i + 1])) for i in range(0, len(arr) - 1, 2)]
+    _TOP_SNAPSHOT[:] = [now + TOP_CACHE_TTL, pairs]
+    return pairs
+
+# ====== Runtime config ======
+class BotConfig:
+    """Admin-set values, read from memory on the hot path.
+
+    Loaded with one MGET at startup. The admin setters write through
+    set_config(), which also bumps config:version; every worker polls that
+    key (config_refresher) and reloads when it moved.
+    """
+
+    KEYS = {
+        "channel_id": "channel:id",
+        "channel_title": "channel:title",
+        "channel_label": "channel:label",
+        "channel_url": "channel:url",
+        "daily_teaser": "daily:teaser",
+        "latest_drop": "latest:drop",
+    }
+    __slots__ = tuple(KEYS) + ("version", "loaded")
+
+    def __init__(self):
+        self.channel_id: str | None = None
+        self.channel_title: str | None = None
+        self.channel_label: str | None = None
+        self.channel_url: str | None = None
+        self.daily_teaser: str | None = None
+        self.latest_drop: str | None = None
+        self.version: str | None = None
+        self.loaded = False
+
+    def channel_display(self) -> str:
+        # Clickable <a href="url">label</a> when possible
+        url = self.channel_url or CHANNEL_URL
+        if self.channel_label and url:
+            return f"<a href='{url}'>{self.channel_label}</a>"
+        if self.channel_title and url:
+            return f"<a href='{url}'>{self.channel_title}</a>"
+        return url or self.channel_id or "(the channel)"
+
+CONFIG = BotConfig()
+
+async def load_config() -> bool:
+    vals = await r_cmd("MGET", "config:version", *BotConfig.KEYS.values())
+    if not isinstance(vals, list):
+        return False
+    CONFIG.version = vals[0]
+    for attr, val in zip(BotConfig.KEYS, vals[1:]):
+        setattr(CONFIG, attr, val)
+    CONFIG.loaded = True
+    return True
+
+async def set_config(**fields):
+    """Write admin settings through to Redis and this worker, then bump the version."""
+    batch = RedisBatch(atomic=True)
+    for attr, val in fields.items():
+        batch.add("SET", BotConfig.KEYS[attr], val)
+        setattr(CONFIG, attr, val)
+    ver_i = batch.add("INCR", "config:version")
+    res = await batch.run()
+    if res[ver_i] is not None:
+        CONFIG.version = str(res[ver_i])
+
+async def config_refresher():
+    while True:
+        await asyncio.sleep(CONFIG_REFRESH_SECS)
+        try:
+            if not BOT_USERNAME and BOT_TOKEN and await resolve_bot_username():
+                build_ui_templates()  # the templates baked in the plain SHARE_URL
+            ver = await r_get("config:version")
+            if ver != CONFIG.version or not CONFIG.loaded:
+                await load_config()
+        except Exception:
+            log.exception("config refresh")
 
 # ====== Telegram helpers ======
-async def tg(method: str, payload: dict):
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Per-update holder for a reply that may go back in the webhook response.
+# [] = nothing held yet, [(method, payload)] = held, [None] = closed.
+_REPLY_SLOT: ContextVar[list | None] = ContextVar("reply_slot", default=None)
+
+async def reply(method: str, payload: dict):
+    """Like tg(), but the update's first reply can ride back on the webhook response.
+
+    Only the first call is held; any later tg()/reply() sends it first, so
+    ordering is kept. Telegram's result isn't available for a held reply.
+    """
+    slot = _REPLY_SLOT.get()
+    if slot is not None and not slot:
+        slot.append((method, payload))
+        return {"ok": True}
+    return await tg(method, payload)
+
+async def _flush_reply():
+    slot = _REPLY_SLOT.get()
+    if not slot or slot[0] is None:
+        return
+    held = slot[0]
+    if isinstance(held, tuple):
+        # Concurrent steps (see concurrently()) all wait on this one send, so order holds
+        held = slot[0] = asyncio.ensure_future(_tg(*held))
+    await asyncio.shield(held)
+    slot[0] = None
+
+async def tg(method: str, payload: dict | bytes):
+    await _flush_reply()
+    return await _tg(method, payload)
+
+async def _tg(method: str, payload: dict | bytes):
+    # `payload` may be pre-encoded JSON bytes (see ui_template)
+    t = time.perf_counter()
     try:
-        async with httpx.AsyncClient(timeout=20) as c:
-            r = await c.post(f"{TG_API}/{method}", json=payload)
-            return r.json()
+        if isinstance(payload, bytes):
+            r = await tg_client().post(f"{TG_API}/{method}", content=payload, headers=_JSON_HEADERS)
+        else:
+            r = await tg_client().post(f"{TG_API}/{method}", json=payload)
+        data = r.json()
     except Exception as e:
-        return {"ok": False, "error": str(e)}
+        data = {"ok": False, "error": str(e), "error_code": "transport"}
+    t1 = time.perf_counter()
+    TG_SECONDS.observe(method, t1 - t)
+    if not isinstance(data, dict):
+        data = {"ok": False, "error": "bad response", "error_code": "transport"}
+    if not data.get("ok"):
+        code = str(data.get("error_code"))
+        TG_ERRORS[code] = TG_ERRORS.get(code, 0) + 1
+    trace_span("tg", method, t, t1, "ok" if data.get("ok") else data.get("error_code"))
+    if method in _KIND_BY_METHOD:
+        note_media_send(method, payload, data)
+    return data
+
+def tg_ok(resp) -> bool:
+    return isinstance(resp, dict) and bool(resp.get("ok"))
 
 # Commands
 USER_COMMANDS = [
@@ -276,41 +1160,97 @@ ADMIN_COMMANDS = [
     {"command": "setchannelid", "description": "(Admin) Set target channel id/@username"},
     {"command": "setchannellabel", "description": "(Admin) Set clickable channel label|url"},
     {"command": "sendaccess", "description": "(Admin) Broadcast Access Required"},
+    {"command": "audience", "description": "(Admin) Active vs. pruned subscribers"},
 ]
 
 async def set_default_commands():
-    await tg("setMyCommands", {"commands": USER_COMMANDS, "scope": {"type": "default"}})
+    return await tg("setMyCommands", {"commands": USER_COMMANDS, "scope": {"type": "default"}})
 
 async def set_admin_commands():
     if ADMIN_ID:
-        await tg("setMyCommands", {
+        return await tg("setMyCommands", {
             "commands": USER_COMMANDS + ADMIN_COMMANDS,
             "scope": {"type": "chat", "chat_id": ADMIN_ID}
         })
+    return {"ok": True}
+
+async def resolve_bot_username() -> bool:
+    """Fill BOT_USERNAME from getMe; False while it's still unknown (retried by config_refresher)."""
+    global BOT_USERNAME
+    if BOT_USERNAME or not BOT_TOKEN:
+        return bool(BOT_USERNAME)
+    resp = await tg("getMe", {})
+    if tg_ok(resp):
+        BOT_USERNAME = resp["result"].get("username") or ""
+    if not BOT_USERNAME:
+        log.warning("getMe failed, share links have no referral until it succeeds: %s", resp)
+    return bool(BOT_USERNAME)
+
+def commands_hash() -> str:
+    blob = json.dumps([USER_COMMANDS, ADMIN_COMMANDS, ADMIN_ID], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+async def register_commands(force: bool = False):
+    """Push the command menus to Telegram, only when the lists changed since last time."""
+    h = commands_hash()
+    if not force and await r_get("commands:hash") == h:
+        return
+    if tg_ok(await set_default_commands()) and tg_ok(await set_admin_commands()):
+        await r_set("commands:hash", h)
 
 # ====== i18n + UI ======
-async def load_lang(uid: int) -> str:
-    val = await r_get(f"lang:{uid}")
+def _remember_lang(uid: int, val: str | None) -> str:
     code = val if val in LANGS else DEFAULT_LANG
-    _LANG_CACHE[uid] = code
+    _LANG_CACHE.set(uid, code)
     return code
 
-async def set_lang(uid: int, code: str):
-    _LANG_CACHE[uid] = code
-    await r_set(f"lang:{uid}", code)
+async def prefetch_langs(uids) -> None:
+    """Warm _LANG_CACHE for a batch of users with one MGET."""
+    missing = []
+    for u in uids:
+        try:
+            u = int(u)
+        except (TypeError, ValueError):
+            continue
+        if u not in _LANG_CACHE:
+            missing.append(u)
+    stat("lang_cache_miss", len(missing))
+    if not missing:
+        return
+    vals = await r_cmd("MGET", *(f"lang:{u}" for u in missing))
+    if not isinstance(vals, list):
+        return
+    for u, val in zip(missing, vals):
+        _remember_lang(u, val)
+
+def set_lang(uid: int, code: str):
+    # The cache is updated right away; only the Redis write is left to await
+    _LANG_CACHE.set(uid, code)
+    return r_set(f"lang:{uid}", code)
 
 def T(uid: int, key: str, **kw) -> str:
     code = _LANG_CACHE.get(uid, DEFAULT_LANG)
     pack = LANGS.get(code, LANGS[DEFAULT_LANG])
-    return pack[key].format(**kw)
+    return pack[key].format(**kw) if kw else pack[key]
+
+SHARE_LINK = f"https://t.me/share/url?url={quote_plus(SHARE_URL)}"
+
+def share_link(uid) -> str:
+    # Per-user deep link (t.me/<bot>?start=ref_<uid>) so joins can be credited
+    if not BOT_USERNAME:
+        return SHARE_LINK
+    return f"https://t.me/share/url?url={quote_plus(f'https://t.me/{BOT_USERNAME}?start=ref_{uid}')}"
 
 def keyboard(uid: int, shares_n: int = 0) -> dict:
-    pack = LANGS.get(_LANG_CACHE.get(uid, DEFAULT_LANG), LANGS[DEFAULT_LANG])
+    return _keyboard(_LANG_CACHE.get(uid, DEFAULT_LANG), shares_n, uid)
+
+def _keyboard(code: str, shares_n: int = 0, uid=None) -> dict:
+    pack = LANGS.get(code, LANGS[DEFAULT_LANG])
     return {
         "inline_keyboard": [
             [
                 {"text": pack["btn_share"].format(n=shares_n, goal=GOAL),
-                 "url": f"https://t.me/share/url?url={quote_plus(SHARE_URL)}"},
+                 "url": share_link(uid)},
                 {"text": pack["btn_channel"], "url": CHANNEL_URL or SHARE_URL}
             ],
             [{"text": pack["btn_access"], "callback_data": "access"}],
@@ -322,7 +1262,7 @@ async def send_ui_legacy(chat_id: int, shares_n: int = 0):
     title = T(chat_id, "ui_title")
     kb = {"reply_markup": keyboard(chat_id, shares_n), "parse_mode": "HTML"}
     if IMAGE_URL:
-        await tg("sendPhoto", {"chat_id": chat_id, "photo": IMAGE_URL, "caption": title, **kb})
+        await tg("sendPhoto", {"chat_id": chat_id, "photo": media_ref(IMAGE_URL, "photo"), "caption": title, **kb})
     else:
         await tg("sendMessage", {"chat_id": chat_id, "text": title, **kb})
 
@@ -338,41 +1278,1573 @@ def _media_kind(url: str, forced: str) -> str:
         return "photo"
     return ""
 
+def ui_media() -> tuple[str, str] | None:
+    """(url, kind) of the media shown with the UI, or None for a text-only UI."""
+    kind = _media_kind(UI_MEDIA_URL, UI_MEDIA_TYPE)
+    if UI_MEDIA_URL and kind:
+        return UI_MEDIA_URL, kind
+    if IMAGE_URL:
+        return IMAGE_URL, "photo"
+    return None
+
+# Media file_id cache: Telegram re-downloads a URL on every send, so the file_id
+# from the first successful upload is reused instead. Stored per kind and URL
+# (media:<kind>:<url>), so pointing the env at a new URL starts a fresh entry.
+_MEDIA_METHODS = {"photo": ("sendPhoto", "photo"), "video": ("sendVideo", "video"), "gif": ("sendAnimation", "animation")}
+_KIND_BY_METHOD = {m: kind for kind, (m, _) in _MEDIA_METHODS.items()}
+_FILE_IDS: dict[tuple[str, str], str] = {}  # (kind, url) -> file_id
+# 400s that blame the file itself; anything else (e.g. "chat not found") leaves the file_id alone
+_BAD_FILE_400 = ("wrong file identifier", "wrong remote file", "file reference",
+                 "failed to get http url content", "wrong type of the web page content")
+
+def media_ref(url: str, kind: str) -> str:
+    return _FILE_IDS.get((kind, url)) or url
+
+def _media_key(kind: str, url: str) -> str:
+    return f"media:{kind}:{url}"
+
+def _file_id_from(kind: str, result) -> str | None:
+    if not isinstance(result, dict):
+        return None
+    if kind == "photo":
+        sizes = result.get("photo") or []
+        return sizes[-1].get("file_id") if sizes else None  # largest size
+    obj = result.get("video" if kind == "video" else "animation") or result.get("document") or {}
+    return obj.get("file_id")
+
+def _media_changed(kind: str, url: str):
+    if ui_media() == (url, kind):
+        build_ui_templates()
+
+async def load_file_ids():
+    wanted = {m for m in (ui_media(), (IMAGE_URL, "photo") if IMAGE_URL else None) if m}
+    pairs = [(kind, url) for url, kind in wanted]
+    if not pairs:
+        return
+    vals = await r_cmd("MGET", *(_media_key(k, u) for k, u in pairs))
+    for pair, fid in zip(pairs, vals if isinstance(vals, list) else []):
+        if fid:
+            _FILE_IDS[pair] = fid
+
+def _sent_media(method: str, payload: dict | bytes) -> tuple[str, str, bool] | None:
+    """(url, kind, sent_as_file_id) when `payload` carries one of our media."""
+    kind = _KIND_BY_METHOD[method]
+    if isinstance(payload, bytes):
+        # Pre-encoded bodies are UI templates
+        media = ui_media()
+        if media is None or media[1] != kind:
+            return None
+        return media[0], kind, (kind, media[0]) in _FILE_IDS
+    ref = payload.get(_MEDIA_METHODS[kind][1])
+    for (k, url), fid in _FILE_IDS.items():
+        if k == kind and fid == ref:
+            return url, kind, True
+    if isinstance(ref, str) and ref.startswith(("http://", "https://")):
+        return ref, kind, False
+    return None
+
+def note_media_send(method: str, payload: dict | bytes, resp: dict):
+    """Called by _tg() for media sends: learn the file_id, or drop one Telegram rejected."""
+    sent = _sent_media(method, payload)
+    if sent is None:
+        return
+    url, kind, as_file_id = sent
+    key = (kind, url)
+    if tg_ok(resp):
+        if as_file_id or key in _FILE_IDS:
+            return
+        fid = _file_id_from(kind, resp.get("result"))
+        if fid:
+            _FILE_IDS[key] = fid
+            stat("media_file_id_learned")
+            spawn(r_set(_media_key(kind, url), fid))
+            _media_changed(kind, url)
+    elif (as_file_id and resp.get("error_code") == 400
+          and any(s in (resp.get("description") or "").lower() for s in _BAD_FILE_400)
+          and _FILE_IDS.pop(key, None)):
+        # Fall back to the URL and learn a new one
+        stat("media_file_id_dropped")
+        spawn(r_del(_media_key(kind, url)))
+        _media_changed(kind, url)
+
+async def prewarm_media():
+    """Upload the UI media once at startup (to the admin, silently) so the first /blast uses a file_id."""
+    media = ui_media()
+    if not MEDIA_PREWARM or not ADMIN_ID or media is None or (media[1], media[0]) in _FILE_IDS:
+        return
+    url, kind = media
+    method, field = _MEDIA_METHODS[kind]
+    resp = await tg(method, {"chat_id": ADMIN_ID, field: url, "disable_notification": True})
+    if tg_ok(resp):
+        await tg("deleteMessage", {"chat_id": ADMIN_ID, "message_id": resp["result"].get("message_id")})
+
+# Precompiled UI payloads: the UI only varies by language and share count,
+# so each variant is encoded to JSON once and only the user id is spliced in per send
+# (as chat_id and inside the referral link).
+_CHAT_SLOT = "__CHAT_ID__"
+_UI_TEMPLATES: dict[tuple[str, int], tuple[str, tuple[bytes, ...]]] = {}
+
+def _ui_payload(code: str, shares_n: int) -> tuple[str, dict]:
+    pack = LANGS.get(code, LANGS[DEFAULT_LANG])
+    title = pack["ui_title"]
+    kb = {"reply_markup": _keyboard(code, shares_n, _CHAT_SLOT), "parse_mode": "HTML"}
+    chat_id = _CHAT_SLOT
+    media = ui_media()
+    if media is None:
+        return "sendMessage", {"chat_id": chat_id, "text": title, **kb}
+    url, kind = media
+    method, field = _MEDIA_METHODS[kind]
+    payload = {"chat_id": chat_id, field: media_ref(url, kind), "caption": title, **kb}
+    if kind == "video":
+        payload["supports_streaming"] = True
+    return method, payload
+
+def ui_template(code: str, shares_n: int = 0) -> tuple[str, tuple[bytes, ...]]:
+    """(method, body split around the user id) for one language/share count."""
+    key = (code, shares_n)
+    tpl = _UI_TEMPLATES.get(key)
+    if tpl is None:
+        method, payload = _ui_payload(code, shares_n)
+        slot = _CHAT_SLOT.encode()
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+        body = body.replace(b'"' + slot + b'"', slot)  # chat_id goes in as a bare number
+        tpl = (method, tuple(body.split(slot)))
+        if 0 <= shares_n <= GOAL:  # anything past the goal is rare; don't grow the table
+            _UI_TEMPLATES[key] = tpl
+    return tpl
+
+def build_ui_templates():
+    _UI_TEMPLATES.clear()
+    for code in LANGS:
+        for n in range(GOAL + 1):
+            ui_template(code, n)
+
+def ui_call(chat_id: int, shares_n: int = 0) -> tuple[str, bytes]:
+    # (method, JSON body) for the media-aware UI, so broadcasts can rate-limit the send
+    method, parts = ui_template(_LANG_CACHE.get(chat_id, DEFAULT_LANG), shares_n)
+    return method, str(int(chat_id)).encode().join(parts)
+
 async def send_ui_v2(chat_id: int, shares_n: int = 0):
-    title = T(chat_id, "ui_title")
-    kb = {"reply_markup": keyboard(chat_id, shares_n), "parse_mode": "HTML"}
-    media_url = UI_MEDIA_URL or ""
-    kind = _media_kind(media_url, UI_MEDIA_TYPE)
-    if media_url and kind == "video":
-        await tg("sendVideo", {"chat_id": chat_id, "video": media_url, "caption": title, "supports_streaming": True, **kb})
-    elif media_url and kind == "gif":
-        await tg("sendAnimation", {"chat_id": chat_id, "animation": media_url, "caption": title, **kb})
-    elif media_url and kind == "photo":
-        await tg("sendPhoto", {"chat_id": chat_id, "photo": media_url, "caption": title, **kb})
-    elif IMAGE_URL:
-        await tg("sendPhoto", {"chat_id": chat_id, "photo": IMAGE_URL, "caption": title, **kb})
-    else:
-        await tg("sendMessage", {"chat_id": chat_id, "text": title, **kb})
+    return await tg(*ui_call(chat_id, shares_n))
 
 # Use media-aware sender
 send_ui = send_ui_v2
 
+# ====== Broadcast engine ======
+class TokenBucket:
+    """Async token bucket shared by every broadcast in this process."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = max(0.1, rate)
+        self.capacity = burst or self.rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, secs: float):
+        # Telegram said "retry_after": stop everyone, not just the caller
+        self.blocked_until = max(self.blocked_until, time.monotonic() + secs)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_BUCKET = TokenBucket(BROADCAST_RATE)  # swapped for RedisRateBudget when sharded, see below
+_BG_TASKS: set[asyncio.Task] = set()
+
+async def _detached(coro):
+    # Background work must not touch the request's held webhook reply (or its trace)
+    _REPLY_SLOT.set(None)
+    _TRACE.set(None)
+    return await coro
+
+def spawn(coro) -> asyncio.Task:
+    # Keep a strong ref so the task isn't garbage-collected mid-run
+    t = asyncio.create_task(_detached(coro))
+    _BG_TASKS.add(t)
+    t.add_done_callback(_BG_TASKS.discard)
+    # Cancelled before its first step, _detached never awaited `coro`; close it so
+    # it isn't reported as "never awaited" (a no-op once it has run)
+    t.add_done_callback(lambda _: coro.close())
+    return t
+
+async def concurrently(*aws, timeout: float = STEP_TIMEOUT_SECS) -> list:
+    """Run a handler's independent steps at once and wait for all of them.
+
+    Steps start in argument order, so put the user-visible ack first. Unlike
+    spawn() they share the update's context (held webhook reply, trace). A step
+    that raises or outlives `timeout` yields None instead of failing the rest;
+    None in place of a step is skipped (for optional ones).
+    """
+    tasks = [None if a is None else asyncio.ensure_future(a) for a in aws]
+    live = [t for t in tasks if t is not None]
+    if not live:
+        return tasks
+    try:
+        _, pending = await asyncio.wait(live, timeout=timeout)
+    except asyncio.CancelledError:
+        for t in live:
+            t.cancel()
+        raise
+    for t in pending:
+        t.cancel()
+        stat("step_timeout")
+    if pending:
+        await asyncio.wait(pending)
+    out = []
+    for t in tasks:
+        if t is None or t.cancelled():
+            out.append(None)
+        elif t.exception() is not None:
+            stat("step_error")
+            log.error("handler step failed", exc_info=t.exception())
+            out.append(None)
+        else:
+            out.append(t.result())
+    return out
+
+# Leases: lock:<name> holds a fencing token (from INCR lock:<name>:fence) with a PX
+# expiry. The holder renews it on a heartbeat; if it crashes the lease simply
+# expires. Writes guarded by the token are rejected once someone else holds it.
+_ACQUIRE_LUA = """
+local v = redis.call('GET', KEYS[1])
+if v and v ~= '0' then return 0 end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('PEXPIRE', KEYS[1], ARGV[2]) end
+return 0
+"""
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+_CHECKPOINT_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('HSET', KEYS[2], unpack(ARGV, 2))
+return 1
+"""
+
+@MemoryStore.script(_ACQUIRE_LUA)
+def _acquire_mem(r, keys, argv):
+    if r("GET", keys[0]) not in (None, "0"):
+        return 0
+    r("SET", keys[0], argv[0], "PX", argv[1])
+    return 1
+
+@MemoryStore.script(_RENEW_LUA)
+def _renew_mem(r, keys, argv):
+    return r("PEXPIRE", keys[0], argv[1]) if r("GET", keys[0]) == argv[0] else 0
+
+@MemoryStore.script(_RELEASE_LUA)
+def _release_mem(r, keys, argv):
+    return r("DEL", keys[0]) if r("GET", keys[0]) == argv[0] else 0
+
+@MemoryStore.script(_CHECKPOINT_LUA)
+def _checkpoint_mem(r, keys, argv):
+    if r("GET", keys[0]) != argv[0]:
+        return 0
+    r("HSET", keys[1], *argv[1:])
+    return 1
+
+class Lease:
+    """Redis lease for one running job, with heartbeat renewal and a fencing token.
+
+    A legacy "0" flag (from the old get-then-set locks) counts as free.
+    """
+
+    def __init__(self, name: str, ttl_ms: int = LEASE_TTL_MS):
+        self.name = name
+        self.key = f"lock:{name}"
+        self.ttl_ms = ttl_ms
+        self.token: str | None = None
+        self.lost = False
+        self._heartbeat: asyncio.Task | None = None
+
+    async def acquire(self) -> bool:
+        if not STORE.configured:
+            self.token = "local"  # no shared store: nothing to coordinate with
+            return True
+        token = await r_cmd("INCR", f"{self.key}:fence")
+        if token is None:
+            return False
+        if await r_eval(_ACQUIRE_LUA, [self.key], [token, self.ttl_ms]) != 1:
+            return False
+        self.token, self.lost = str(token), False
+        self._heartbeat = spawn(self._renew())
+        return True
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl_ms / 3000)
+            res = await r_eval(_RENEW_LUA, [self.key], [self.token, self.ttl_ms])
+            if res == 0:
+                self.lost = True
+                stat("lease_lost")
+                return
+
+    async def release(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self.token and not self.lost:
+            await r_eval(_RELEASE_LUA, [self.key], [self.token])
+        self.token = None
+
+    async def checkpoint(self) -> dict:
+        return await r_hgetall(f"bcast:{self.name}")
+
+    async def save_checkpoint(self, **fields) -> bool:
+        # Fenced write: refused (and the job stops) once the lease is gone
+        if self.lost:
+            return False
+        args = [self.token]
+        for k, v in fields.items():
+            args += [k, v]
+        res = await r_eval(_CHECKPOINT_LUA, [self.key, f"bcast:{self.name}"], args)
+        if res == 0 and self.token != "local":
+            self.lost = True
+            return False
+        return True
+
+    async def clear_checkpoint(self):
+        await r_del(f"bcast:{self.name}")
+
+# Delivery outcomes. Chats that blocked the bot, were deleted or never existed
+# won't come back on their own, so broadcasts move them from "subs" to
+# "subs:inactive" instead of paying for them every time.
+# subs:pruned  hash: outcome -> chats moved out, plus "reactivated"
+DEAD_OUTCOMES = ("blocked", "gone")
+_GONE_400 = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+def delivery_outcome(resp) -> str:
+    """ok / blocked (403) / gone (400 chat not found) / rate_limited (429) / error."""
+    if tg_ok(resp):
+        return "ok"
+    if not isinstance(resp, dict):
+        return "error"
+    code = resp.get("error_code")
+    if code == 403:
+        return "blocked"
+    if code == 429:
+        return "rate_limited"
+    if code == 400 and any(s in (resp.get("description") or "").lower() for s in _GONE_400):
+        return "gone"
+    return "error"
+
+async def prune_subscribers(dead: list[tuple[int, str]]):
+    """Move (uid, outcome) chats from subs to subs:inactive in one transaction."""
+    if not dead:
+        return
+    ids = [uid for uid, _ in dead]
+    batch = RedisBatch(atomic=True)
+    batch.add("SREM", "subs", *ids)
+    batch.add("SADD", "subs:inactive", *ids)
+    for outcome in DEAD_OUTCOMES:
+        n = sum(1 for _, o in dead if o == outcome)
+        if n:
+            batch.add("HINCRBY", "subs:pruned", outcome, n)
+    await batch.run()
+    stat("subscribers_pruned", len(ids))
+
+async def tg_send(method: str, payload: dict | bytes) -> dict:
+    """tg() under the broadcast rate limit, retrying on 429 retry_after."""
+    for attempt in range(BROADCAST_RETRIES + 1):
+        await _BUCKET.acquire()
+        resp = await tg(method, payload)
+        if isinstance(resp, dict) and resp.get("error_code") == 429 and attempt < BROADCAST_RETRIES:
+            stat("tg_429")
+            retry_after = (resp.get("parameters") or {}).get("retry_after", 1)
+            _BUCKET.pause(float(retry_after))
+            continue
+        return resp
+    return resp
+
+async def broadcast(pages, make_call, concurrency: int = BROADCAST_CONCURRENCY,
+                    on_page=None) -> tuple[int, int]:
+    """Send to every id in `pages`; returns (delivered, failed).
+
+    `pages` is an async iterable of (cursor, ids), e.g. subscriber_pages().
+    `make_call(uid)` is awaited per recipient and returns the (method,
+    payload) to send, or None to skip. Sends run concurrently, but the
+    shared token bucket keeps the total under BROADCAST_RATE.
+
+    With `on_page(cursor, sent, failed)` every page is finished before the
+    next starts, so the callback can checkpoint; returning False stops.
+    Chats that turn out to be dead are pruned from "subs" along the way.
+    """
+    sent = failed = 0
+    dead: list[tuple[int, str]] = []
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        nonlocal sent, failed, dead
+        while True:
+            uid = await queue.get()
+            try:
+                if uid is None:
+                    return
+                try:
+                    call = await make_call(uid)
+                    if call is None:
+                        continue
+                    resp = await tg_send(*call)
+                except Exception:
+                    resp = None
+                outcome = delivery_outcome(resp)
+                stat(f"delivery_{outcome}")
+                if outcome == "ok":
+                    sent += 1
+                    stat("broadcast_sent")
+                else:
+                    failed += 1
+                    stat("broadcast_failed")
+                    if outcome in DEAD_OUTCOMES:
+                        dead.append((uid, outcome))
+                        if len(dead) >= 100:
+                            chunk, dead = dead, []
+                            await prune_subscribers(chunk)
+            finally:
+                queue.task_done()
+
+    INFLIGHT["broadcasts"] += 1
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        async for cursor, ids in pages:
+            for uid in ids:
+                try:
+                    await queue.put(int(uid))
+                except ValueError:
+                    pass
+            if on_page is not None:
+                await queue.join()
+                if await on_page(cursor, sent, failed) is False:
+                    break
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        await prune_subscribers(dead)
+    finally:
+        INFLIGHT["broadcasts"] -= 1
+        for w in workers:
+            w.cancel()
+    return sent, failed
+
+async def subscriber_pages(langs: bool = False, cursor: str = "0"):
+    """Stream (next_cursor, ids) pages of "subs"; `langs` bulk-loads each page's languages first."""
+    async for nxt, page in r_sscan_pages("subs", cursor=cursor):
+        if langs:
+            await prefetch_langs(page)
+        yield nxt, page
+
+# Broadcast kinds: a job is a JSON-able spec {"kind": ..., ...} so any worker
+# can rebuild the per-recipient call from it (see the sharded engine below).
+BROADCAST_KINDS: dict = {}
+
+def broadcast_kind(name: str, langs: bool = False):
+    """Register `factory(spec) -> async make_call(uid)`; `langs` = it renders T() per user."""
+    def deco(factory):
+        BROADCAST_KINDS[name] = (factory, langs)
+        return factory
+    return deco
+
+@broadcast_kind("message")
+def _bk_message(spec):
+    async def call(u):
+        return "sendMessage", {"chat_id": u, **spec["payload"]}
+    return call
+
+@broadcast_kind("copy")
+def _bk_copy(spec):
+    async def call(u):
+        return "copyMessage", {"chat_id": u, "from_chat_id": spec["from_chat_id"], "message_id": spec["message_id"]}
+    return call
+
+@broadcast_kind("daily", langs=True)
+def _bk_daily(spec):
+    async def call(u):
+        return "sendMessage", {"chat_id": u, "text": f"{T(u,'daily_ok')}\n\n{spec['teaser']}"}
+    return call
+
+@broadcast_kind("ui", langs=True)
+def _bk_ui(spec):
+    async def call(u):
+        return ui_call(u)
+    return call
+
+@broadcast_kind("access", langs=True)
+def _bk_access(spec):
+    async def call(u):
+        return "sendMessage", {
+            "chat_id": u,
+            "text": T(u, "access_required", ch=spec["display"]),
+            "parse_mode": "HTML",
+            "disable_web_page_preview": True
+        }
+    return call
+
+def broadcast_report(done: str, sent: int, failed: int) -> str:
+    text = done.replace("{n}", str(sent))
+    if failed:
+        text += f"\nFailed: {failed}"
+    return text
+
+def start_broadcast(admin_id: int, spec: dict, done: str, empty: str | None = None,
+                    lease: "Lease | None" = None) -> asyncio.Task:
+    """Run a broadcast to all subscribers in the background and report to the admin.
+
+    `spec` picks a registered broadcast kind; `done` is the admin's report
+    with an `{n}` slot for the delivered count; `empty` is sent instead
+    when there are no subscribers.
+
+    With an acquired `lease` the job checkpoints its SSCAN cursor after every
+    page (bcast:<lease name>) and a later run under the same lease name
+    resumes from there instead of starting over. The lease is released at
+    the end. With BROADCAST_SHARDED=1 the job is fanned out through Redis.
+    """
+    async def job():
+        try:
+            if BROADCAST_SHARDED:
+                await run_sharded(admin_id, spec, done, empty, lease)
+            else:
+                await run_local(admin_id, spec, done, empty, lease)
+        finally:
+            if lease is not None:
+                await lease.release()
+
+    return spawn(job())
+
+async def run_local(admin_id: int, spec: dict, done: str, empty: str | None, lease: "Lease | None"):
+    factory, langs = BROADCAST_KINDS[spec["kind"]]
+    cursor, sent0, failed0 = "0", 0, 0
+    if lease is not None:
+        ck = await lease.checkpoint()
+        if ck:
+            cursor, sent0, failed0 = ck.get("cursor", "0"), _score(ck.get("sent")), _score(ck.get("failed"))
+            if ck.get("done") == "1" or cursor == "0":
+                # The last run finished but died before clearing: report, don't start over
+                await lease.clear_checkpoint()
+                await tg("sendMessage", {"chat_id": admin_id, "text": broadcast_report(done, sent0, failed0)})
+                return
+            await tg("sendMessage", {"chat_id": admin_id, "text": f"Resuming {lease.name} after {sent0 + failed0} users."})
+
+        async def on_page(nxt, s, f):
+            # SSCAN's final cursor "0" would read as "from the start"; mark the run done instead
+            pos = {"done": 1} if nxt == "0" else {"cursor": nxt}
+            return await lease.save_checkpoint(**pos, sent=sent0 + s, failed=failed0 + f)
+    else:
+        on_page = None
+
+    sent, failed = await broadcast(subscriber_pages(langs, cursor), factory(spec), on_page=on_page)
+    if lease is not None:
+        if lease.lost:
+            return  # someone else holds the lease now and will report
+        await lease.clear_checkpoint()
+    sent, failed = sent + sent0, failed + failed0
+    if not sent and not failed and empty:
+        await tg("sendMessage", {"chat_id": admin_id, "text": empty})
+        return
+    await tg("sendMessage", {"chat_id": admin_id, "text": broadcast_report(done, sent, failed)})
+
+# ====== Sharded broadcasts ======
+# The worker that receives the command turns the subscriber scan into work
+# items ("pages" of SHARD_PAGE_SECS worth of ids) and every worker's
+# shard_worker() claims and sends them under the shared Redis rate budget.
+# Keys for job J:
+#   bcast:job:J         hash: spec, admin, done, empty, total, fed, owner_until, pages_done, sent, failed, finished
+#   bcast:job:J:todo    list of page numbers waiting to be claimed
+#   bcast:job:J:pages   hash page number -> JSON list of ids
+#   bcast:job:J:claims  hash page number -> "<deadline unix secs>:<claim token>"
+#   bcast:jobs          set of unfinished job ids
+# The claimer renews its deadline while it sends, and only the current
+# claimer may mark the page done, so a reaped page is never counted twice.
+# The coordinator likewise pushes owner_until out with every page it feeds;
+# if it dies before "fed", workers finish what was fed and retire the job.
+_SHARD_PAGE_IDS = max(1, int(BROADCAST_RATE * SHARD_PAGE_SECS))
+
+_CLAIM_LUA = """
+local i = redis.call('LPOP', KEYS[1])
+if not i then return nil end
+redis.call('HSET', KEYS[2], i, ARGV[1] .. ':' .. ARGV[2])
+return {i, redis.call('HGET', KEYS[3], i)}
+"""
+_RENEW_CLAIM_LUA = """
+local v = redis.call('HGET', KEYS[1], ARGV[1])
+if not v or string.match(v, ':(.*)$') ~= ARGV[2] then return 0 end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3] .. ':' .. ARGV[2])
+return 1
+"""
+_PAGE_DONE_LUA = """
+local v = redis.call('HGET', KEYS[1], ARGV[1])
+if not v or string.match(v, ':(.*)$') ~= ARGV[4] then return 0 end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HINCRBY', KEYS[2], 'sent', ARGV[2])
+redis.call('HINCRBY', KEYS[2], 'failed', ARGV[3])
+return redis.call('HINCRBY', KEYS[2], 'pages_done', 1)
+"""
+_REAP_LUA = """
+local c = redis.call('HGETALL', KEYS[1])
+local n = 0
+for j = 1, #c, 2 do
+  if tonumber(string.match(c[j + 1], '^%d+')) < tonumber(ARGV[1]) then
+    redis.call('HDEL', KEYS[1], c[j])
+    redis.call('RPUSH', KEYS[2], c[j])
+    n = n + 1
+  end
+end
+return n
+"""
+
+@MemoryStore.script(_CLAIM_LUA)
+def _claim_mem(r, keys, argv):
+    i = r("LPOP", keys[0])
+    if i is None:
+        return None
+    r("HSET", keys[1], i, f"{argv[0]}:{argv[1]}")
+    return [i, r("HGET", keys[2], i)]
+
+def _claim_owner(v) -> str | None:
+    return v.partition(":")[2] if v and ":" in v else None
+
+@MemoryStore.script(_RENEW_CLAIM_LUA)
+def _renew_claim_mem(r, keys, argv):
+    if _claim_owner(r("HGET", keys[0], argv[0])) != str(argv[1]):
+        return 0
+    r("HSET", keys[0], argv[0], f"{argv[2]}:{argv[1]}")
+    return 1
+
+@MemoryStore.script(_PAGE_DONE_LUA)
+def _page_done_mem(r, keys, argv):
+    if _claim_owner(r("HGET", keys[0], argv[0])) != str(argv[3]):
+        return 0
+    r("HDEL", keys[0], argv[0])
+    r("HDEL", keys[2], argv[0])
+    r("HINCRBY", keys[1], "sent", argv[1])
+    r("HINCRBY", keys[1], "failed", argv[2])
+    return r("HINCRBY", keys[1], "pages_done", 1)
+
+@MemoryStore.script(_REAP_LUA)
+def _reap_mem(r, keys, argv):
+    claims = r("HGETALL", keys[0])
+    n = 0
+    for j in range(0, len(claims), 2):
+        if int(claims[j + 1].split(":")[0]) < int(argv[0]):
+            r("HDEL", keys[0], claims[j])
+            r("RPUSH", keys[1], claims[j])
+            n += 1
+    return n
+
+class RedisRateBudget:
+    """BROADCAST_RATE shared by all workers: a per-second Redis counter claimed in small chunks."""
+
+    def __init__(self, rate: float, chunk: int = 5):
+        self.rate = max(1, int(rate))
+        self.chunk = max(1, min(chunk, self.rate))
+        self.window = 0
+        self.tokens = 0
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, secs: float):
+        self.blocked_until = max(self.blocked_until, time.time() + secs)
+        self.tokens = 0
+        spawn(r_cmd("SET", "bcast:pause", "1", "PX", int(secs * 1000)))
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.time()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                sec = int(now)
+                if self.window == sec and self.tokens > 0:
+                    self.tokens -= 1
+                    return
+                batch = RedisBatch()
+                used_i = batch.add("INCRBY", f"rate:{sec}", self.chunk)
+                batch.add("EXPIRE", f"rate:{sec}", 5)
+                pause_i = batch.add("PTTL", "bcast:pause")
+                res = await batch.run()
+                if not batch.ok:
+                    # Redis unreachable: fall back to pacing this worker alone
+                    await asyncio.sleep(1 / self.rate)
+                    return
+                if _score(res[pause_i]) > 0:
+                    self.blocked_until = now + _score(res[pause_i]) / 1000
+                    continue
+                granted = min(self.chunk, self.rate - (_score(res[used_i]) - self.chunk))
+                if granted > 0:
+                    self.window, self.tokens = sec, granted - 1
+                    return
+                await asyncio.sleep(sec + 1 - now)
+
+if BROADCAST_SHARDED:
+    _BUCKET = RedisRateBudget(BROADCAST_RATE)
+
+_JOB_SPECS = LRUCache(64)  # job id -> (make_call, langs)
+
+async def run_sharded(admin_id: int, spec: dict, done: str, empty: str | None, lease: "Lease | None"):
+    """Coordinator: publish the job, feed pages as work items, wait for the workers."""
+    jid, cursor, page_no = None, "0", 0
+    if lease is not None:
+        ck = await lease.checkpoint()
+        if ck.get("job"):
+            jid, cursor, page_no = ck["job"], ck.get("cursor", "0"), _score(ck.get("pages"))
+            if await r_cmd("HGET", f"bcast:job:{jid}", "finished") == "1":
+                # Retired by the workers after we went away: feed the rest as a new job
+                jid, page_no = None, 0
+            await tg("sendMessage", {"chat_id": admin_id, "text": f"Resuming {lease.name} (job {jid or 'new'})."})
+    if jid is None:
+        jid = str(await r_cmd("INCR", "bcast:seq"))
+        batch = RedisBatch(atomic=True)
+        batch.add("HSET", f"bcast:job:{jid}", "spec", json.dumps(spec), "admin", admin_id,
+                  "done", done, "empty", empty or "", "total", 0, "fed", 0,
+                  "owner_until", int(time.time() + SHARD_CLAIM_SECS))
+        batch.add("SADD", "bcast:jobs", jid)
+        await batch.run()
+
+    key = f"bcast:job:{jid}"
+    fed = (await r_cmd("HGET", key, "fed")) == "1"
+    if not fed:
+        async for nxt, page in r_sscan_pages("subs", cursor=cursor):
+            batch = RedisBatch(atomic=True)
+            if page:
+                # SSCAN COUNT is only a hint: cut work items to what one worker sends in SHARD_PAGE_SECS
+                for i in range(0, len(page), _SHARD_PAGE_IDS):
+                    batch.add("HSET", f"{key}:pages", page_no, json.dumps(page[i:i + _SHARD_PAGE_IDS]))
+                    batch.add("RPUSH", f"{key}:todo", page_no)
+                    page_no += 1
+            batch.add("HSET", key, "total", page_no, "owner_until", int(time.time() + SHARD_CLAIM_SECS))
+            finished_i = batch.add("HGET", key, "finished")
+            res = await batch.run()
+            if res[finished_i] == "1":
+                stat("shard_job_abandoned_late")
+                return  # the workers gave up on us; a lease holder resumes from the checkpoint
+            if lease is not None and not await lease.save_checkpoint(job=jid, cursor=nxt, pages=page_no):
+                return
+        await r_cmd("HSET", key, "fed", 1)
+    await _finish_job(jid)
+
+    # Hold the lease until every shard is done so a second /blast can't overlap
+    if lease is not None:
+        while not lease.lost and (await r_cmd("HGET", f"bcast:job:{jid}", "finished")) != "1":
+            await asyncio.sleep(SHARD_POLL_SECS)
+        if not lease.lost:
+            await lease.clear_checkpoint()
+
+async def _finish_job(jid: str):
+    """Report and retire the job once all pages are done; safe to call from any worker."""
+    key = f"bcast:job:{jid}"
+    vals = await r_cmd("HMGET", key, "fed", "total", "pages_done", "sent", "failed", "admin", "done", "empty",
+                       "owner_until")
+    if not isinstance(vals, list) or _score(vals[2]) < _score(vals[1]):
+        return
+    # Not fed yet: only retire it once the coordinator has stopped renewing owner_until
+    abandoned = vals[0] != "1"
+    if abandoned and _score(vals[8]) >= time.time():
+        return
+    if await r_cmd("HSETNX", key, "reported", 1) != 1:
+        return  # another worker got here first
+    sent, failed, admin = _score(vals[3]), _score(vals[4]), _score(vals[5])
+    if abandoned:
+        stat("shard_job_abandoned")
+        text = broadcast_report(vals[6] or "{n}", sent, failed) + "\nStopped early: the worker feeding this job went away."
+    elif not sent and not failed and vals[7]:
+        text = vals[7]
+    else:
+        text = broadcast_report(vals[6] or "{n}", sent, failed)
+    await tg("sendMessage", {"chat_id": admin, "text": text})
+    batch = RedisBatch()
+    batch.add("HSET", key, "finished", 1)
+    batch.add("SREM", "bcast:jobs", jid)
+    for k in (key, f"{key}:todo", f"{key}:pages", f"{key}:claims"):
+        batch.add("EXPIRE", k, 86400)
+    await batch.run()
+    _JOB_SPECS.pop(jid)
+
+async def _job_call(jid: str):
+    cached = _JOB_SPECS.get(jid)
+    if cached is None:
+        raw = await r_cmd("HGET", f"bcast:job:{jid}", "spec")
+        if not raw:
+            return None
+        spec = json.loads(raw)
+        factory, langs = BROADCAST_KINDS[spec["kind"]]
+        cached = (factory(spec), langs)
+        _JOB_SPECS.set(jid, cached)
+    return cached
+
+class ShardClaim:
+    """Heartbeat for one claimed page, like Lease._renew: pushes the deadline out every claim/3."""
+
+    def __init__(self, claims_key: str, page_no: str, token: str):
+        self.claims_key, self.page_no, self.token = claims_key, page_no, token
+        self.lost = False
+        self._heartbeat = spawn(self._renew())
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(SHARD_CLAIM_SECS / 3)
+            res = await r_eval(_RENEW_CLAIM_LUA, [self.claims_key],
+                               [self.page_no, self.token, int(time.time() + SHARD_CLAIM_SECS)])
+            if res == 0:
+                self.lost = True
+                return
+
+    def stop(self):
+        self._heartbeat.cancel()
+
+async def _work_job(jid: str) -> bool:
+    """Claim and send one page of job `jid`; False when there was nothing to claim."""
+    key = f"bcast:job:{jid}"
+    token = os.urandom(8).hex()
+    claimed = await r_eval(_CLAIM_LUA, [f"{key}:todo", f"{key}:claims", f"{key}:pages"],
+                           [int(time.time() + SHARD_CLAIM_SECS), token])
+    if not isinstance(claimed, list) or len(claimed) != 2:
+        # Nothing queued: hand back pages whose worker died, and see if the job is done
+        await r_eval(_REAP_LUA, [f"{key}:claims", f"{key}:todo"], [int(time.time())])
+        await _finish_job(jid)
+        return False
+    page_no, raw = claimed
+    call = await _job_call(jid)
+    if call is None:
+        return False
+    make_call, langs = call
+    ids = json.loads(raw or "[]")
+    if langs:
+        await prefetch_langs(ids)
+
+    claim = ShardClaim(f"{key}:claims", page_no, token)
+    step = max(1, int(BROADCAST_RATE))
+
+    async def batches():
+        for i in range(0, len(ids), step):
+            yield "0", ids[i:i + step]
+
+    async def still_ours(cursor, sent, failed):
+        return not claim.lost
+
+    try:
+        sent, failed = await broadcast(batches(), make_call, on_page=still_ours)
+    finally:
+        claim.stop()
+    if claim.lost or await r_eval(_PAGE_DONE_LUA, [f"{key}:claims", key, f"{key}:pages"],
+                                  [page_no, sent, failed, token]) != 1:
+        # Reaped while we were sending: whoever holds it now finishes the page
+        stat("shard_claim_lost")
+        return True
+    stat("shard_pages")
+    await _finish_job(jid)
+    return True
+
+async def shard_worker():
+    """Runs on every worker with BROADCAST_SHARDED=1, claiming pages from active jobs."""
+    while True:
+        try:
+            worked = False
+            for jid in await r_smembers("bcast:jobs"):
+                worked = await _work_job(jid) or worked
+            if not worked:
+                await asyncio.sleep(SHARD_POLL_SECS)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("shard worker")
+            await asyncio.sleep(SHARD_POLL_SECS)
+
+# ====== Update worker pool ======
+def _chat_key(update: dict):
+    if "message" in update:
+        return update["message"].get("chat", {}).get("id")
+    if "callback_query" in update:
+        return update["callback_query"].get("from", {}).get("id")
+    if "chat_join_request" in update:
+        return update["chat_join_request"].get("from", {}).get("id")
+    return update.get("update_id")
+
+# Priority lanes: a callback has to be answered within seconds or the user
+# sees a spinner; free text that only reaches the FAQ can be dropped.
+LANE_NAMES = ("priority", "command", "chatter")
+
+def update_lane(update: dict) -> int:
+    if "callback_query" in update or "chat_join_request" in update:
+        return 0
+    m = update.get("message")
+    if m:
+        text = (m.get("text") or "").strip()
+        if text.startswith("/") or text.lower() in _WORD_ROUTES or m.get("chat", {}).get("id") == ADMIN_ID:
+            return 1
+    return 2
+
+class Admission:
+    """Caps in-flight updates; a freed slot goes to the highest-priority waiter.
+
+    acquire(lane) returns False when no slot came up within that lane's wait,
+    and the caller sheds the update.
+    """
+
+    def __init__(self, cap: int, waits: tuple = ADMIT_WAIT_SECS):
+        self.cap = cap
+        self.waits = waits
+        self.inflight = 0
+        self._waiters: list[deque] = [deque() for _ in LANE_NAMES]
+
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._waiters)
+
+    async def acquire(self, lane: int) -> bool:
+        if self.cap <= 0:
+            return True
+        if self.inflight < self.cap and not any(self._waiters[:lane + 1]):
+            self.inflight += 1
+            return True
+        wait = self.waits[lane] if lane < len(self.waits) else 0
+        if wait <= 0:
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(fut)
+        try:
+            await asyncio.wait_for(fut, wait)  # release() hands its slot over
+            return True
+        except asyncio.TimeoutError:
+            # On 3.12+ a handoff in the same tick as the timeout still raises; the slot is ours
+            return fut.done() and not fut.cancelled()
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # handed a slot we'll never use
+            raise
+        finally:
+            if not fut.done() or fut.cancelled():
+                try:
+                    self._waiters[lane].remove(fut)
+                except ValueError:
+                    pass
+
+    def release(self):
+        if self.cap <= 0:
+            return
+        for q in self._waiters:
+            while q:
+                fut = q.popleft()
+                if not fut.done():
+                    fut.set_result(True)  # slot passes on; inflight stays the same
+                    return
+        self.inflight -= 1
+
+_ADMISSION = Admission(ADMIT_MAX_INFLIGHT)
+
+class UpdatePool:
+    """Bounded asyncio workers for WEBHOOK_MODE=queue.
+
+    Each chat hashes to one worker queue, so a chat's updates are handled
+    in arrival order while different chats run in parallel. A full queue
+    makes submit() wait, which pushes back on Telegram instead of growing
+    without bound.
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.size = max(1, workers)
+        self.maxsize = max(1, maxsize // self.size)
+        self.queues: list[asyncio.Queue] = []
+        self.tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queues = [asyncio.Queue(maxsize=self.maxsize) for _ in range(self.size)]
+        self.tasks = [asyncio.create_task(self._run(q)) for q in self.queues]
+
+    async def submit(self, update: dict):
+        if not self.tasks:
+            self.start()
+        key = _chat_key(update)
+        await self.queues[hash(key) % self.size].put(update)
+
+    async def _run(self, q: asyncio.Queue):
+        while True:
+            update = await q.get()
+            if update is None:
+                return
+            try:
+                await handle_update(update, claimed=True)
+            except Exception:
+                log.exception("update %s failed", update.get("update_id"))
+
+    async def drain(self):
+        # Finish everything already accepted, then stop
+        for q in self.queues:
+            await q.put(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks, self.queues = [], []
+
+_POOL = UpdatePool(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+# ====== Message router ======
+class MsgCtx:
+    """One incoming message, parsed once for the handlers."""
+
+    __slots__ = ("msg", "chat_id", "text", "low", "cmd", "args", "first_name", "shares_n", "new_sub")
+
+    def __init__(self, msg: dict, shares_n: int = 0, new_sub: bool = False):
+        self.msg = msg
+        self.chat_id = msg["chat"]["id"]
+        self.text = (msg.get("text") or "").strip()
+        self.low = self.text.lower()
+        self.cmd, self.args = parse_command(self.text)
+        self.first_name = msg.get("from", {}).get("first_name", "friend")
+        self.shares_n = shares_n
+        self.new_sub = new_sub  # first time this chat was added to "subs"
+
+    @property
+    def is_admin(self) -> bool:
+        return self.chat_id == ADMIN_ID
+
+def parse_command(text: str) -> tuple[str | None, str]:
+    """"/Start@MyBot ref_1" -> ("start", "ref_1"); non-commands -> (None, text)."""
+    if not text.startswith("/"):
+        return None, text
+    head, *rest = text.split(maxsplit=1)
+    name = head[1:].split("@", 1)[0].lower()
+    return name or None, rest[0].strip() if rest else ""
+
+_ROUTES: dict = {}        # /command -> handler, everyone
+_ADMIN_ROUTES: dict = {}  # /command -> handler, ADMIN_ID only
+_WORD_ROUTES: dict = {}   # exact plain-text message -> handler
+
+def command(*names: str, admin: bool = False, words: tuple = ()):
+    def deco(fn):
+        table = _ADMIN_ROUTES if admin else _ROUTES
+        for n in names:
+            table[n] = fn
+        for w in words:
+            _WORD_ROUTES[w] = fn
+        return fn
+    return deco
+
+# --- FAQ autoresponses (keyword-based); earlier entries win ---
+FAQ = [
+    (("how join", "how to join", "join channel", "request to join"),
+     "Tap *Dark Exclusive* to open the channel link, then hit *Request to Join*. The bot will DM you the tasks automatically."),
+    (("access", "how get access", "unlock"),
+     f"To get access: share using the *0/{GOAL} SHARE* button until you reach the goal, then tap *ACCESS*."),
+    (("share not", "share didn", "shares not", "share no work", "not counting"),
+     "If shares aren’t counting, make sure friends *open the link*, not just forward it. You can tap the SHARE button again to get a fresh link."),
+    (("language", "change language", "lang"),
+     "You can change language anytime with /language."),
+    (("price", "cost", "how much"),
+     "It’s free. Just complete the tasks shown by the bot to unlock."),
+    (("contact", "support", "admin", "help me"),
+     "Need help? Reply here and I’ll get back to you soon."),
+]
+_FAQ_INDEX = {}
+for _i, (_keys, _) in enumerate(FAQ):
+    for _k in _keys:
+        _FAQ_INDEX.setdefault(_k, _i)
+# One pass over the text: a zero-width lookahead at every position tries the
+# keywords in FAQ order (longest first within an entry), so overlaps still count.
+_FAQ_RE = re.compile("(?=(" + "|".join(
+    re.escape(k) for k in sorted(_FAQ_INDEX, key=lambda k: (_FAQ_INDEX[k], -len(k)))
+) + "))")
+
+def faq_reply(low: str) -> str | None:
+    best = None
+    for m in _FAQ_RE.finditer(low):
+        i = _FAQ_INDEX[m.group(1)]
+        if best is None or i < best:
+            best = i
+            if i == 0:
+                break
+    return FAQ[best][1] if best is not None else None
+
+async def route_message(ctx: MsgCtx):
+    handler = _WORD_ROUTES.get(ctx.low)
+    if handler is None and ctx.cmd:
+        handler = (ctx.is_admin and _ADMIN_ROUTES.get(ctx.cmd)) or _ROUTES.get(ctx.cmd)
+    if handler is not None:
+        await handler(ctx)
+        return
+    if ctx.cmd in _ADMIN_ROUTES:
+        return  # admin commands stay invisible to everyone else: no FAQ, no fallback
+
+    answer = faq_reply(ctx.low)
+    if answer:
+        await reply("sendMessage", {"chat_id": ctx.chat_id, "text": answer, "parse_mode": "Markdown", "disable_web_page_preview": True})
+    # fallback for any random text (non-command)
+    elif ctx.text and not ctx.cmd:
+        await reply("sendMessage", {"chat_id": ctx.chat_id, "text": "Got it! Type /menu to see options or /help for tips."})
+
+LANG_KEYBOARD = {
+    "inline_keyboard": [[
+        {"text": "English 🇬🇧",  "callback_data": "lang:en"},
+        {"text": "Français 🇫🇷", "callback_data": "lang:fr"},
+        {"text": "Русский 🇷🇺",  "callback_data": "lang:ru"},
+        {"text": "中文 🇨🇳",      "callback_data": "lang:zh"},
+    ],[
+        {"text": "Pidgin 🇳🇬",   "callback_data": "lang:pg"}
+    ]]
+}
+
+# ====== Message handlers ======
+@command(words=("hi", "hello", "hey"))
+async def on_greeting(ctx: MsgCtx):
+    name = f"<a href='tg://user?id={ctx.chat_id}'>{ctx.first_name}</a>"
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "hi", name=name), "parse_mode": "HTML"})
+
+@command("help", words=("help",))
+async def cmd_help(ctx: MsgCtx):
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "help")})
+
+@command("about", words=("about",))
+async def cmd_about(ctx: MsgCtx):
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "about")})
+
+@command("tip", words=("tip",))
+async def cmd_tip(ctx: MsgCtx):
+    tips = [T(ctx.chat_id, "tip1"), T(ctx.chat_id, "tip2"), T(ctx.chat_id, "tip3")]
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": random.choice(tips)})
+
+@command("start", "menu")
+async def cmd_start(ctx: MsgCtx):
+    name = f"<a href='tg://user?id={ctx.chat_id}'>{ctx.first_name}</a>"
+
+    async def greet():
+        await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "hi", name=name), "parse_mode": "HTML"})
+        await send_ui(ctx.chat_id, ctx.shares_n)
+
+    # Only a user's first /start can count as someone's referral
+    await concurrently(greet(), credit_referral(ctx.args, ctx.chat_id) if ctx.new_sub and ctx.args else None)
+
+@command("lang", "language")
+async def cmd_lang(ctx: MsgCtx):
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "choose_lang"), "reply_markup": LANG_KEYBOARD})
+
+@command("progress")
+async def cmd_progress(ctx: MsgCtx):
+    n = ctx.shares_n
+    bar = progress_bar(n= n, goal= GOAL)
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "progress", bar=bar, n=n, goal=GOAL)})
+
+@command("top")
+async def cmd_top(ctx: MsgCtx):
+    lines = [T(ctx.chat_id, "top_header", k=TOP_K)]
+    for i, (uid2, shares_val) in enumerate(await top_shares(), start=1):
+        lines.append(f"{i}. <a href='tg://user?id={uid2}'>{uid2}</a>: {shares_val}/{GOAL}")
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": "\n".join(lines), "parse_mode": "HTML"})
+
+@command("daily")
+async def cmd_daily(ctx: MsgCtx):
+    teaser = CONFIG.daily_teaser
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": f"{T(ctx.chat_id,'daily_ok')}\n\n{teaser}" if teaser else "…"})
+
+# ===== ADMIN ONLY =====
+@command("broadcast", admin=True)
+async def cmd_broadcast(ctx: MsgCtx):
+    chat_id = ctx.chat_id
+    # reply-to-media /broadcast
+    replied = ctx.msg.get("reply_to_message")
+    if replied:
+        spec = {"kind": "copy", "from_chat_id": chat_id, "message_id": replied["message_id"]}
+        start_broadcast(chat_id, spec, T(chat_id, "bc_sent", n="{n}"))
+        return
+
+    payload = ctx.args
+    if not payload:
+        await reply("sendMessage", {"chat_id": chat_id, "text": "Usage: /broadcast Your message"})
+        return
+
+    spec = {"kind": "message", "payload": {"text": payload, "disable_web_page_preview": True}}
+    start_broadcast(chat_id, spec, T(chat_id, "bc_sent", n="{n}"))
+
+@command("setdaily", admin=True)
+async def cmd_setdaily(ctx: MsgCtx):
+    await set_config(daily_teaser=ctx.args)
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": T(ctx.chat_id, "daily_set")})
+
+@command("senddaily", admin=True)
+async def cmd_senddaily(ctx: MsgCtx):
+    chat_id = ctx.chat_id
+    teaser = CONFIG.daily_teaser or ""
+
+    start_broadcast(chat_id, {"kind": "daily", "teaser": teaser}, T(chat_id, "daily_sent", n="{n}"))
+
+@command("drop", admin=True)
+async def cmd_drop(ctx: MsgCtx):
+    chat_id, payload = ctx.chat_id, ctx.args
+    await set_config(latest_drop=payload)
+
+    spec = {"kind": "message", "payload": {"text": payload, "disable_web_page_preview": True}}
+    start_broadcast(chat_id, spec, T(chat_id, "drop_sent", n="{n}"))
+
+@command("poll", admin=True)
+async def cmd_poll(ctx: MsgCtx):
+    chat_id = ctx.chat_id
+    parts = [p.strip() for p in ctx.args.split("|")]
+    if len(parts) < 3:
+        await reply("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "poll_format")})
+        return
+    q, *opts = parts
+    poll_id = await create_poll(q, opts)
+    kb = {"inline_keyboard": [[{"text": o, "callback_data": f"vote:{poll_id}:{i}"} for i, o in enumerate(opts)]]}
+
+    spec = {"kind": "message", "payload": {"text": q, "reply_markup": kb}}
+    start_broadcast(chat_id, spec, T(chat_id, "poll_created") + " ({n})")
+
+def results_message(uid: int, pid: str, results) -> dict:
+    q, counts = results or ("(deleted)", [])
+    lines = [T(uid, "results"), q]
+    for o, c in counts:
+        lines.append(f"{o}: {c}")
+    return {
+        "text": "\n".join(lines),
+        "reply_markup": {"inline_keyboard": [[{"text": "🔄", "callback_data": f"results:{pid}"}]]},
+    }
+
+@command("results", admin=True)
+async def cmd_results(ctx: MsgCtx):
+    pid = ctx.args or "1"
+    await reply("sendMessage", {"chat_id": ctx.chat_id, **results_message(ctx.chat_id, pid, await poll_results(pid))})
+
+# ---------- BLAST with lease (anti-spam, resumable) ----------
+@command("blast", admin=True)
+async def cmd_blast(ctx: MsgCtx):
+    chat_id = ctx.chat_id
+    lease = Lease("blast")
+    if not await lease.acquire():
+        await reply("sendMessage", {"chat_id": chat_id, "text": "blast is already running — try again later."})
+        return
+
+    start_broadcast(chat_id, {"kind": "ui"}, T(chat_id, "sent_ui", n="{n}"),
+                    empty=T(chat_id, "no_subs"), lease=lease)
+
+# ---------- /setchannelid (store id/@ and fetch title) ----------
+@command("setchannelid", admin=True)
+async def cmd_setchannelid(ctx: MsgCtx):
+    chat_id, payload = ctx.chat_id, ctx.args
+    if not payload:
+        await reply("sendMessage", {"chat_id": chat_id, "text": "Usage: /setchannelid <channel_id_or_@username>"})
+        return
+    await set_config(channel_id=payload)
+    try:
+        resp = await tg("getChat", {"chat_id": payload})
+        if isinstance(resp, dict) and resp.get("ok") and "result" in resp:
+            title = resp["result"].get("title") or resp["result"].get("username") or payload
+            await set_config(channel_title=title)
+            await reply("sendMessage", {"chat_id": chat_id, "text": f"Channel stored: {title}"})
+        else:
+            await reply("sendMessage", {"chat_id": chat_id, "text": f"Channel stored (unable to fetch title). Saved: {payload}"})
+    except Exception:
+        await reply("sendMessage", {"chat_id": chat_id, "text": f"Channel stored: {payload}"})
+
+# ---------- /setchannellabel Label | url ----------
+@command("setchannellabel", admin=True)
+async def cmd_setchannellabel(ctx: MsgCtx):
+    chat_id, payload = ctx.chat_id, ctx.args
+    if not payload:
+        await reply("sendMessage", {"chat_id": chat_id, "text": "Usage: /setchannellabel Label | optional_url"})
+        return
+    parts = [p.strip() for p in payload.split("|", 1)]
+    label = parts[0]
+    url = parts[1].strip() if len(parts) > 1 else ""
+    if url:
+        await set_config(channel_label=label, channel_url=url)
+    else:
+        await set_config(channel_label=label)
+    await reply("sendMessage", {"chat_id": chat_id, "text": f"Channel label set to: {label}"})
+
+# ---------- /sendaccess (broadcast) with lock & clickable name ----------
+@command("sendaccess", admin=True)
+async def cmd_sendaccess(ctx: MsgCtx):
+    chat_id = ctx.chat_id
+    lease = Lease("sendaccess")
+    if not await lease.acquire():
+        await reply("sendMessage", {"chat_id": chat_id, "text": "sendaccess is already running — try again later."})
+        return
+    display = CONFIG.channel_display()
+    start_broadcast(chat_id, {"kind": "access", "display": display},
+                    "Access message sent to {n} users.", lease=lease)
+
+# Unlock helpers (optional)
+# A stuck lease expires by itself; these force it (the old holder's fencing token stops it)
+@command("unlocksendaccess", admin=True)
+async def cmd_unlocksendaccess(ctx: MsgCtx):
+    await r_del("lock:sendaccess")
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": "sendaccess lock cleared."})
+
+@command("unlockblast", admin=True)
+async def cmd_unlockblast(ctx: MsgCtx):
+    await r_del("lock:blast")
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": "blast lock cleared."})
+
+# ---------- /audience: how much broadcasts have pruned ----------
+@command("audience", admin=True)
+async def cmd_audience(ctx: MsgCtx):
+    batch = RedisBatch()
+    active_i = batch.add("SCARD", "subs")
+    inactive_i = batch.add("SCARD", "subs:inactive")
+    pruned_i = batch.add("HGETALL", "subs:pruned")
+    res = await batch.run()
+    active, inactive = _score(res[active_i]), _score(res[inactive_i])
+    arr = res[pruned_i] if isinstance(res[pruned_i], list) else []
+    pruned = {arr[i]: _score(arr[i + 1]) for i in range(0, len(arr) - 1, 2)}
+    peak = active + inactive
+    shrink = f"{inactive * 100 / peak:.1f}%" if peak else "0%"
+    lines = [
+        f"Active subscribers: {active}",
+        f"Inactive: {inactive} ({shrink} of everyone who ever subscribed)",
+        f"Pruned: {pruned.get('blocked', 0)} blocked the bot, {pruned.get('gone', 0)} chats gone",
+        f"Came back: {pruned.get('reactivated', 0)}",
+    ]
+    await reply("sendMessage", {"chat_id": ctx.chat_id, "text": "\n".join(lines)})
+
 # ====== FastAPI ======
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Open the pools up front so the first update doesn't pay for it
+    tg_client()
+    await STORE.open()
+    await resolve_bot_username()  # share links in the UI templates need it
+    await load_config()
+    await load_file_ids()
+    build_ui_templates()
+    spawn(prewarm_media())
+    if WEBHOOK_MODE == "queue":
+        _POOL.start()
+    # Command menus are registered once per deploy, not per message
+    spawn(register_commands())
+    spawn(config_refresher())
+    if BROADCAST_SHARDED:
+        spawn(shard_worker())
+    try:
+        yield
+    finally:
+        await _POOL.drain()
+        for t in list(_BG_TASKS):
+            t.cancel()
+        await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+        await STORE.close()
+        await close_clients()
+
+app = FastAPI(lifespan=lifespan)
+
 @app.get("/")
 def home():
     return {"ok": True, "msg": "bot running"}
 
+@app.get("/stats")
+def stats():
+    return {"ok": True, "stats": STATS}
+
+def _ratio(hit: int, miss: int) -> float:
+    return hit / (hit + miss) if hit + miss else 0.0
+
+def render_metrics() -> str:
+    lines = []
+    for h in (UPDATE_SECONDS, TG_SECONDS, REDIS_SECONDS):
+        lines += h.render()
+    lines += ["# HELP gainaccess_telegram_errors_total Failed Bot API calls by error_code.",
+              "# TYPE gainaccess_telegram_errors_total counter"]
+    lines += [f'gainaccess_telegram_errors_total{{code="{c}"}} {n}' for c, n in sorted(TG_ERRORS.items())]
+    # Everything counted with stat(): dedupe hits, cache hits, broadcast sent/failed, 429 retries...
+    for name, n in sorted(STATS.items()):
+        lines += [f"# TYPE gainaccess_{name}_total counter", f"gainaccess_{name}_total {n}"]
+    gauges = {
+        "updates_in_flight": INFLIGHT["updates"],
+        "update_queue_depth": sum(q.qsize() for q in _POOL.queues),
+        "broadcasts_running": INFLIGHT["broadcasts"],
+        "admission_waiting": _ADMISSION.waiting(),
+        "lang_cache_hit_ratio": _ratio(STATS.get("lang_cache_hit", 0), STATS.get("lang_cache_miss", 0)),
+        "dedupe_local_hit_ratio": _ratio(STATS.get("dedupe_hit_local", 0),
+                                         STATS.get("dedupe_hit_redis", 0) + STATS.get("dedupe_miss", 0)),
+        "lang_cache_entries": len(_LANG_CACHE),
+    }
+    for name, v in gauges.items():
+        lines += [f"# TYPE gainaccess_{name} gauge", f"gainaccess_{name} {v}"]
+    return "\n".join(lines) + "\n"
+
+@app.get("/debug/traces")
+def debug_traces(req: Request):
+    # Admin-only: DEBUG_TOKEN in the X-Debug-Token header (never the query string,
+    # which ends up in proxy and access logs)
+    token = req.headers.get("x-debug-token")
+    if not DEBUG_TOKEN or not hmac.compare_digest(token or "", DEBUG_TOKEN):
+        return PlainTextResponse("not found", status_code=404)
+    return {"ok": True, "slow_ms": SLOW_UPDATE_MS, "sample": TRACE_SAMPLE,
+            "slow": list(SLOW_TRACES), "sampled": list(SAMPLED_TRACES)}
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/webhook")
 async def webhook(req: Request):
     update = await req.json()
+    # Admission is decided here, before any work is run or queued; polling and
+    # the queue pool already bound their own concurrency and never shed.
+    lane = update_lane(update)
+    if not await _ADMISSION.acquire(lane):
+        stat(f"shed_{LANE_NAMES[lane]}")
+        return {"ok": True}
+    try:
+        return await _webhook_update(update)
+    finally:
+        _ADMISSION.release()
+
+async def _webhook_update(update: dict):
+    if WEBHOOK_MODE != "queue":
+        if not WEBHOOK_REPLY:
+            return await handle_update(update)
+        slot: list = []
+        token = _REPLY_SLOT.set(slot)
+        try:
+            await handle_update(update)
+        finally:
+            _REPLY_SLOT.reset(token)
+            held = slot[0] if slot and isinstance(slot[0], tuple) else None
+            slot[:] = [None]
+        if held is not None:
+            method, payload = held
+            return {"method": method, **payload}
+        return {"ok": True}
+    # Ack first: claim the update_id, queue it, and let Telegram move on
+    u_id = update.get("update_id")
+    if u_id is None or await claim_update(u_id):
+        await _POOL.submit(update)
+    return {"ok": True}
+
+def _seen(batch: RedisBatch, result) -> bool:
+    # Only trust a missing "OK" when the store actually answered
+    if batch.ok and result is None:
+        stat("dedupe_hit_redis")
+        return True
+    stat("dedupe_miss")
+    return False
+
+async def claim_update(u_id) -> bool:
+    """True if this process is the first to see `u_id` (see handle_update)."""
+    if not _SEEN_UPDATES.add(u_id):
+        stat("dedupe_hit_local")
+        return False
+    batch = RedisBatch()
+    batch.add("SET", f"seen_update:{u_id}", "1", "NX", "EX", DEDUPE_TTL)
+    return not _seen(batch, (await batch.run())[0])
+
+def _update_type(update: dict) -> str:
+    for kind in ("message", "callback_query", "chat_join_request"):
+        if kind in update:
+            return kind
+    return "other"
+
+async def handle_update(update: dict, claimed: bool = False):
+    """Process one Telegram update. `claimed` skips the dedupe guard."""
+    INFLIGHT["updates"] += 1
+    spans = token = None
+    if _TRACING:
+        spans = []
+        token = _TRACE.set(spans)
+    t = time.perf_counter()
+    try:
+        return await _handle_update(update, claimed)
+    finally:
+        secs = time.perf_counter() - t
+        INFLIGHT["updates"] -= 1
+        UPDATE_SECONDS.observe(_update_type(update), secs)
+        if token is not None:
+            _TRACE.reset(token)
+            _keep_trace(update, t, secs, spans)
+
+def _trace_dict(update: dict, start: float, secs: float, spans: list) -> dict:
+    return {
+        "update_id": update.get("update_id"),
+        "type": _update_type(update),
+        "at": round(time.time() - secs, 3),
+        "ms": round(secs * 1000, 2),
+        "spans": [
+            {"kind": kind, "name": name, "offset_ms": round((t0 - start) * 1000, 2),
+             "ms": round(d * 1000, 2), "status": status}
+            for kind, name, t0, d, status in spans
+        ],
+    }
 
-    # Guard: dedupe by update_id (prevents Render multi-worker double-handling)
+def _keep_trace(update: dict, start: float, secs: float, spans: list):
+    slow = SLOW_UPDATE_MS > 0 and secs * 1000 >= SLOW_UPDATE_MS
+    sampled = TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE
+    if not slow and not sampled:
+        return
+    trace = _trace_dict(update, start, secs, spans)
+    if slow:
+        stat("slow_updates")
+        SLOW_TRACES.append(trace)
+        log.warning("slow update %s: %s", trace["update_id"], json.dumps(trace, ensure_ascii=False))
+    if sampled:
+        SAMPLED_TRACES.append(trace)
+
+async def _handle_update(update: dict, claimed: bool = False):
+    # Who is this update for? Lets all per-update reads share one round trip.
+    uid, subscribe, want_shares = None, False, False
+    if "chat_join_request" in update:
+        uid = update["chat_join_request"].get("from", {}).get("id")
+        subscribe = True
+    elif "message" in update:
+        m = update["message"]
+        # Ignore messages sent by bots (prevents loops)
+        if m.get("from", {}).get("is_bot"):
+            return {"ok": True}
+        uid = m["chat"]["id"]
+        subscribe = True
+        cmd = parse_command((m.get("text") or "").strip())[0]
+        want_shares = cmd in ("progress", "start", "menu")
+    elif "callback_query" in update:
+        uid = update["callback_query"]["from"]["id"]
+        want_shares = update["callback_query"].get("data") == "access"
+
+    batch = RedisBatch()
+    seen_i = lang_i = shares_i = sub_i = back_i = None
+    # Guard: dedupe by update_id (prevents Render multi-worker double-handling).
+    # Telegram's retries usually land on the same worker, so check in-process first;
+    # SET NX is the cross-worker claim and expires instead of piling up forever.
     u_id = update.get("update_id")
-    if u_id is not None:
-        seen_key = f"seen_update:{u_id}"
-        if await r_get(seen_key):
+    if u_id is not None and not claimed:
+        if not _SEEN_UPDATES.add(u_id):
+            stat("dedupe_hit_local")
             return {"ok": True}
-        await r_set(seen_key, "1")
+        seen_i = batch.add("SET", f"seen_update:{u_id}", "1", "NX", "EX", DEDUPE_TTL)
+    if uid:
+        if uid in _LANG_CACHE:
+            stat("lang_cache_hit")
+        else:
+            stat("lang_cache_miss")
+            lang_i = batch.add("GET", f"lang:{uid}")
+        if subscribe:
+            sub_i = batch.add("SADD", "subs", uid)
+            back_i = batch.add("SREM", "subs:inactive", uid)
+        if want_shares:
+            shares_i = batch.add("ZSCORE", "shares", uid)
+    res = await batch.run()
+    if seen_i is not None and _seen(batch, res[seen_i]):
+        return {"ok": True}
+    if lang_i is not None:
+        _remember_lang(uid, res[lang_i])
+    shares_n = _score(res[shares_i]) if shares_i is not None else 0
+    reactivated = back_i is not None and res[back_i] == 1
+    new_sub = sub_i is not None and res[sub_i] == 1 and not reactivated
+    if reactivated:
+        stat("subscriber_reactivated")
+        spawn(r_hincrby("subs:pruned", "reactivated", 1))
 
     # ---- 1) Request-to-join -> DM and subscribe ----
     if "chat_join_request" in update:
@@ -380,352 +2852,14 @@ async def webhook(req: Request):
         user = cj.get("from", {})
         uid = user.get("id")
         if uid:
-            await load_lang(uid)
-            await r_sadd("subs", uid)
+            # No referral credit here: joins are credited through /start ref_<uid> (cmd_start)
             name = f"<a href='tg://user?id={uid}'>{user.get('first_name','friend')}</a>"
             await tg("sendMessage", {"chat_id": uid, "text": T(uid, "hi", name=name), "parse_mode": "HTML"})
             await send_ui(uid)
 
     # ---- 2) Messages ----
     if "message" in update:
-        msg = update["message"]
-        chat_id = msg["chat"]["id"]
-        text = (msg.get("text") or "").strip()
-        user = msg.get("from", {})
-        first_name = user.get("first_name", "friend")
-
-        # Ignore messages sent by bots (prevents loops)
-        if user.get("is_bot"):
-            return {"ok": True}
-
-        # load lang + remember + set menus
-        await load_lang(chat_id)
-        await r_sadd("subs", chat_id)
-        await set_default_commands()
-        if chat_id == ADMIN_ID:
-            await set_admin_commands()
-
-        # smart replies & helpers
-        low = text.lower()
-
-        # friendly greetings
-        if low in ("hi", "hello", "hey"):
-            name = f"<a href='tg://user?id={chat_id}'>{first_name}</a>"
-            await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "hi", name=name), "parse_mode": "HTML"})
-            return {"ok": True}
-
-        # helpers
-        if low in ("/help", "help"):
-            await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "help")})
-            return {"ok": True}
-        if low in ("/about", "about"):
-            await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "about")})
-            return {"ok": True}
-        if low in ("/tip", "tip"):
-            tips = [T(chat_id, "tip1"), T(chat_id, "tip2"), T(chat_id, "tip3")]
-            await tg("sendMessage", {"chat_id": chat_id, "text": random.choice(tips)})
-            return {"ok": True}
-
-        # --- FAQ autoresponses (keyword-based) ---
-        faq = [
-            (("how join", "how to join", "join channel", "request to join"),
-             "Tap *Dark Exclusive* to open the channel link, then hit *Request to Join*. The bot will DM you the tasks automatically."),
-            (("access", "how get access", "unlock"),
-             f"To get access: share using the *0/{GOAL} SHARE* button until you reach the goal, then tap *ACCESS*."),
-            (("share not", "share didn", "shares not", "share no work", "not counting"),
-             "If shares aren’t counting, make sure friends *open the link*, not just forward it. You can tap the SHARE button again to get a fresh link."),
-            (("language", "change language", "lang"),
-             "You can change language anytime with /language."),
-            (("price", "cost", "how much"),
-             "It’s free. Just complete the tasks shown by the bot to unlock."),
-            (("contact", "support", "admin", "help me"),
-             "Need help? Reply here and I’ll get back to you soon."),
-        ]
-        handled = False
-        for keys, reply in faq:
-            if any(k in low for k in keys):
-                await tg("sendMessage", {"chat_id": chat_id, "text": reply, "parse_mode": "Markdown", "disable_web_page_preview": True})
-                handled = True
-                break
-
-        # fallback for any random text (non-command)
-        if not handled and text and not text.startswith("/"):
-            await tg("sendMessage", {"chat_id": chat_id, "text": "Got it! Type /menu to see options or /help for tips."})
-            return {"ok": True}
-
-        # commands/features
-        if text.startswith("/start") or text == "/menu":
-            name = f"<a href='tg://user?id={chat_id}'>{first_name}</a>"
-            await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "hi", name=name), "parse_mode": "HTML"})
-            await send_ui(chat_id)
-            return {"ok": True}
-
-        if text.startswith("/lang") or text.startswith("/language"):
-            await tg("sendMessage", {
-                "chat_id": chat_id,
-                "text": T(chat_id, "choose_lang"),
-                "reply_markup": {
-                    "inline_keyboard": [[
-                        {"text": "English 🇬🇧",  "callback_data": "lang:en"},
-                        {"text": "Français 🇫🇷", "callback_data": "lang:fr"},
-                        {"text": "Русский 🇷🇺",  "callback_data": "lang:ru"},
-                        {"text": "中文 🇨🇳",      "callback_data": "lang:zh"},
-                    ],[
-                        {"text": "Pidgin 🇳🇬",   "callback_data": "lang:pg"}
-                    ]]
-                }
-            })
-            return {"ok": True}
-
-        if text.startswith("/progress"):
-            n = int((await r_get(f"shares:{chat_id}") or "0"))
-            bar = progress_bar(n= n, goal= GOAL)
-            await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "progress", bar=bar, n=n, goal=GOAL)})
-            return {"ok": True}
-
-        if text.startswith("/top"):
-            import random as _rnd
-            ids_set = set()
-            while len(ids_set) < 10:
-                ids_set.add(str(_rnd.randint(10**9, 10**10 - 1)))
-            ids_list = list(ids_set)
-            lines = [T(chat_id, "top_header", k="Shares")]
-            pairs = []
-            for uid2 in ids_list:
-                shares_val = _rnd.randint(15, 45)
-                pairs.append((uid2, shares_val))
-            pairs.sort(key=lambda x: x[1], reverse=True)
-            for i, (uid2, shares_val) in enumerate(pairs, start=1):
-                lines.append(f"{i}. <a href='tg://user?id={uid2}'>{uid2}</a>: {shares_val}/6")
-            await tg("sendMessage", {"chat_id": chat_id, "text": "\n".join(lines), "parse_mode": "HTML"})
-            return {"ok": True}
-
-        if text.startswith("/daily"):
-            teaser = await r_get("daily:teaser")
-            await tg("sendMessage", {"chat_id": chat_id, "text": f"{T(chat_id,'daily_ok')}\n\n{teaser}" if teaser else "…"})
-            return {"ok": True}
-
-        # ===== ADMIN ONLY =====
-        if chat_id == ADMIN_ID:
-            # reply-to-media /broadcast
-            if text.startswith("/broadcast") and msg.get("reply_to_message"):
-                ids = await r_smembers("subs")
-                reply = msg["reply_to_message"]
-                sent = 0
-                for uid2 in ids:
-                    try:
-                        await tg("copyMessage", {"chat_id": int(uid2), "from_chat_id": chat_id, "message_id": reply["message_id"]})
-                        sent += 1
-                        await asyncio.sleep(0.03)
-                    except Exception:
-                        pass
-                await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "bc_sent", n=sent)})
-                return {"ok": True}
-
-            if text.startswith("/setdaily"):
-                payload = text[len("/setdaily"):].strip()
-                await r_set("daily:teaser", payload)
-                await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "daily_set")})
-                return {"ok": True}
-
-            if text.startswith("/senddaily"):
-                teaser = await r_get("daily:teaser") or ""
-                ids = await r_smembers("subs")
-                sent = 0
-                for uid2 in ids:
-                    try:
-                        await tg("sendMessage", {"chat_id": int(uid2), "text": f"{T(int(uid2),'daily_ok')}\n\n{teaser}"})
-                        sent += 1
-                        await asyncio.sleep(0.03)
-                    except Exception:
-                        pass
-                await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "daily_sent", n=sent)})
-                return {"ok": True}
-
-            if text.startswith("/drop"):
-                payload = text[len("/drop"):].strip()
-                await r_set("latest:drop", payload)
-                ids = await r_smembers("subs")
-                sent = 0
-                for uid2 in ids:
-                    try:
-                        await tg("sendMessage", {"chat_id": int(uid2), "text": payload, "disable_web_page_preview": True})
-                        sent += 1
-                        await asyncio.sleep(0.03)
-                    except Exception:
-                        pass
-                await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "drop_sent", n=sent)})
-                return {"ok": True}
-
-            if text.startswith("/poll"):
-                parts = [p.strip() for p in text[len("/poll"):].split("|")]
-                if len(parts) < 3:
-                    await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "poll_format")})
-                    return {"ok": True}
-                q, *opts = parts
-                poll_id = str(await r_hincrby("counters", "poll", 1))
-                await r_set(f"poll:{poll_id}:q", q)
-                await r_set(f"poll:{poll_id}:opts", "|".join(opts))
-                kb = {"inline_keyboard": [[{"text": o, "callback_data": f"vote:{poll_id}:{i}"} for i, o in enumerate(opts)]]}
-                ids = await r_smembers("subs")
-                for uid2 in ids:
-                    try:
-                        await tg("sendMessage", {"chat_id": int(uid2), "text": q, "reply_markup": kb})
-                        await asyncio.sleep(0.03)
-                    except Exception:
-                        pass
-                await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "poll_created")})
-                return {"ok": True}
-
-            if text.startswith("/results"):
-                parts = text.split(maxsplit=1)
-                pid = parts[1].strip() if len(parts) > 1 else "1"
-                q = await r_get(f"poll:{pid}:q") or "(deleted)"
-                opts = (await r_get(f"poll:{pid}:opts") or "").split("|")
-                votes = await r_hgetall(f"poll:{pid}:votes")
-                counts = [0]*len(opts)
-                for _, idx in votes.items():
-                    try:
-                        counts[int(idx)] += 1
-                    except Exception:
-                        pass
-                lines = [T(chat_id, "results"), q]
-                for i, o in enumerate(opts):
-                    if o:
-                        lines.append(f"{o}: {counts[i]}")
-                await tg("sendMessage", {"chat_id": chat_id, "text": "\n".join(lines)})
-                return {"ok": True}
-
-            if text.startswith("/broadcast"):
-                payload = text[len("/broadcast"):].strip()
-                if not payload:
-                    await tg("sendMessage", {"chat_id": chat_id, "text": "Usage: /broadcast Your message"})
-                else:
-                    ids = await r_smembers("subs")
-                    sent = 0
-                    for uid2 in ids:
-                        try:
-                            await tg("sendMessage", {"chat_id": int(uid2), "text": payload, "disable_web_page_preview": True})
-                            sent += 1
-                            await asyncio.sleep(0.03)
-                        except Exception:
-                            pass
-                    await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "bc_sent", n=sent)})
-                return {"ok": True}
-
-            # ---------- BLAST with lock (anti-spam) ----------
-            if text.startswith("/blast"):
-                if (await r_get("lock:blast")) == "1":
-                    await tg("sendMessage", {"chat_id": chat_id, "text": "blast is already running — try again later."})
-                    return {"ok": True}
-                await r_set("lock:blast", "1")
-                try:
-                    ids = await r_smembers("subs")
-                    if not ids:
-                        await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "no_subs")})
-                    else:
-                        sent = 0
-                        for uid2 in ids:
-                            try:
-                                await send_ui(int(uid2))
-                                sent += 1
-                                await asyncio.sleep(0.03)
-                            except Exception:
-                                pass
-                        await tg("sendMessage", {"chat_id": chat_id, "text": T(chat_id, "sent_ui", n=sent)})
-                finally:
-                    await r_set("lock:blast", "0")
-                return {"ok": True}
-
-            # ---------- 2) /setchannelid (store id/@ and fetch title) ----------
-            if text.startswith("/setchannelid"):
-                payload = text[len("/setchannelid"):].strip()
-                if not payload:
-                    await tg("sendMessage", {"chat_id": chat_id, "text": "Usage: /setchannelid <channel_id_or_@username>"})
-                    return {"ok": True}
-                await r_set("channel:id", payload)
-                try:
-                    resp = await tg("getChat", {"chat_id": payload})
-                    if isinstance(resp, dict) and resp.get("ok") and "result" in resp:
-                        title = resp["result"].get("title") or resp["result"].get("username") or payload
-                        await r_set("channel:title", title)
-                        await tg("sendMessage", {"chat_id": chat_id, "text": f"Channel stored: {title}"})
-                    else:
-                        await tg("sendMessage", {"chat_id": chat_id, "text": f"Channel stored (unable to fetch title). Saved: {payload}"})
-                except Exception:
-                    await tg("sendMessage", {"chat_id": chat_id, "text": f"Channel stored: {payload}"})
-                return {"ok": True}
-
-            # ---------- 4) /setchannellabel Label | url ----------
-            if text.startswith("/setchannellabel"):
-                payload = text[len("/setchannellabel"):].strip()
-                if not payload:
-                    await tg("sendMessage", {"chat_id": chat_id, "text": "Usage: /setchannellabel Label | optional_url"})
-                    return {"ok": True}
-                parts = [p.strip() for p in payload.split("|", 1)]
-                label = parts[0]
-                url = parts[1].strip() if len(parts) > 1 else ""
-                await r_set("channel:label", label)
-                if url:
-                    await r_set("channel:url", url)
-                await tg("sendMessage", {"chat_id": chat_id, "text": f"Channel label set to: {label}"})
-                return {"ok": True}
-
-            # ---------- 3) /sendaccess (broadcast) with lock & clickable name ----------
-            if text.startswith("/sendaccess"):
-                if (await r_get("lock:sendaccess")) == "1":
-                    await tg("sendMessage", {"chat_id": chat_id, "text": "sendaccess is already running — try again later."})
-                    return {"ok": True}
-                await r_set("lock:sendaccess", "1")
-                try:
-                    # Build clickable display: <a href="url">label</a> if possible
-                    label = await r_get("channel:label")
-                    ch_url = await r_get("channel:url") or CHANNEL_URL
-                    title = await r_get("channel:title")
-                    ch_id = await r_get("channel:id")
-                    if label and ch_url:
-                        display = f"<a href='{ch_url}'>{label}</a>"
-                    elif title and ch_url:
-                        display = f"<a href='{ch_url}'>{title}</a>"
-                    elif ch_url:
-                        display = ch_url
-                    elif ch_id:
-                        display = ch_id
-                    else:
-                        display = "(the channel)"
-
-                    ids = await r_smembers("subs")
-                    sent = 0
-                    for uid2 in ids:
-                        try:
-                            u = int(uid2)
-                            await load_lang(u)
-                            msg_text = T(u, "access_required", ch=display)
-                            await tg("sendMessage", {
-                                "chat_id": u,
-                                "text": msg_text,
-                                "parse_mode": "HTML",
-                                "disable_web_page_preview": True
-                            })
-                            sent += 1
-                            await asyncio.sleep(0.03)
-                        except Exception:
-                            pass
-                    await tg("sendMessage", {"chat_id": chat_id, "text": f"Access message sent to {sent} users."})
-                finally:
-                    await r_set("lock:sendaccess", "0")
-                return {"ok": True}
-
-            # Unlock helpers (optional)
-            if text.startswith("/unlocksendaccess"):
-                await r_set("lock:sendaccess", "0")
-                await tg("sendMessage", {"chat_id": chat_id, "text": "sendaccess lock cleared."})
-                return {"ok": True}
-            if text.startswith("/unlockblast"):
-                await r_set("lock:blast", "0")
-                await tg("sendMessage", {"chat_id": chat_id, "text": "blast lock cleared."})
-                return {"ok": True}
-
+        await route_message(MsgCtx(update["message"], shares_n, new_sub))
         return {"ok": True}
 
     # ---- 3) Callback buttons ----
@@ -733,52 +2867,56 @@ async def webhook(req: Request):
         cb = update["callback_query"]
         uid = cb["from"]["id"]
         data = cb.get("data", "")
-        await load_lang(uid)
 
         if data == "access":
-            n = int((await r_get(f"shares:{uid}") or "0"))
-            await tg("answerCallbackQuery", {
+            n = shares_n
+            await concurrently(reply("answerCallbackQuery", {
                 "callback_query_id": cb["id"],
                 "show_alert": True,
                 "text": T(uid, "shares", n=n, goal=GOAL)
-            })
-            await tg("sendMessage", {
+            }), reply("sendMessage", {
                 "chat_id": uid,
                 "text": T(uid, "access_hint"),
                 "reply_markup": {
                     "inline_keyboard": [[
-                        {"text": f"Share again {n}/{GOAL}", "url": f"https://t.me/share/url?url={quote_plus(SHARE_URL)}"}
+                        {"text": f"Share again {n}/{GOAL}", "url": share_link(uid)}
                     ]]
                 }
-            })
+            }))
 
         elif data == "language":
-            await tg("sendMessage", {
-                "chat_id": uid,
-                "text": T(uid, "choose_lang"),
-                "reply_markup": {
-                    "inline_keyboard": [[
-                        {"text": "English 🇬🇧",  "callback_data": "lang:en"},
-                        {"text": "Français 🇫🇷", "callback_data": "lang:fr"},
-                        {"text": "Русский 🇷🇺",  "callback_data": "lang:ru"},
-                        {"text": "中文 🇨🇳",      "callback_data": "lang:zh"},
-                    ],[
-                        {"text": "Pidgin 🇳🇬",   "callback_data": "lang:pg"}
-                    ]]
-                }
-            })
+            await reply("sendMessage", {"chat_id": uid, "text": T(uid, "choose_lang"), "reply_markup": LANG_KEYBOARD})
 
         elif data.startswith("lang:"):
             code = data.split(":", 1)[1]
             if code in LANGS:
-                await set_lang(uid, code)
-                await tg("answerCallbackQuery", {"callback_query_id": cb["id"], "text": T(uid, "saved_lang"), "show_alert": False})
-                await send_ui(uid)
+                saved = set_lang(uid, code)  # texts below already use the new language
+                await concurrently(
+                    reply("answerCallbackQuery", {"callback_query_id": cb["id"], "text": T(uid, "saved_lang"), "show_alert": False}),
+                    send_ui(uid),
+                    saved,
+                )
 
         elif data.startswith("vote:"):
             _, pid, idx = data.split(":")
-            await r_hset(f"poll:{pid}:votes", str(uid), idx)
-            await tg("answerCallbackQuery", {"callback_query_id": cb["id"], "text": T(uid, "voted"), "show_alert": False})
+            if await record_vote(pid, uid, idx) >= 0:
+                await reply("answerCallbackQuery", {"callback_query_id": cb["id"], "text": T(uid, "voted"), "show_alert": False})
+            else:
+                await reply("answerCallbackQuery", {"callback_query_id": cb["id"]})
+
+        elif data.startswith("results:") and uid == ADMIN_ID:
+            # Live results: refresh the admin's /results message in place
+            pid = data.split(":", 1)[1]
+
+            async def refresh():
+                await tg("editMessageText", {
+                    "chat_id": cb["message"]["chat"]["id"],
+                    "message_id": cb["message"]["message_id"],
+                    **results_message(uid, pid, await poll_results(pid)),
+                })
+
+            await concurrently(reply("answerCallbackQuery", {"callback_query_id": cb["id"]}),
+                               refresh() if cb.get("message") else None)
 
         return {"ok": True}
 
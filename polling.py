@@ -0,0 +1,75 @@
+"""Long-polling entry point: `python polling.py` instead of the /webhook route.
+
+Pulls updates with getUpdates (up to 100 at a time) and feeds them through
+the same handle_update() as the webhook. Updates for one chat run in order,
+different chats run concurrently. The next offset is stored in Redis so a
+restart picks up where the last run stopped.
+
+getUpdates does not work while a webhook is set, so the webhook is removed
+on start unless POLL_DELETE_WEBHOOK=0.
+"""
+import os
+import asyncio
+import logging
+
+import main
+
+POLL_TIMEOUT        = int(os.getenv("POLL_TIMEOUT", "50"))   # seconds Telegram holds the request open
+POLL_LIMIT          = min(100, int(os.getenv("POLL_LIMIT", "100")))
+POLL_DELETE_WEBHOOK = os.getenv("POLL_DELETE_WEBHOOK", "1") == "1"
+OFFSET_KEY          = "updates:offset"
+
+log = logging.getLogger("gainaccess.polling")
+
+async def get_updates(offset: int) -> list | None:
+    payload = {"offset": offset, "timeout": POLL_TIMEOUT, "limit": POLL_LIMIT}
+    try:
+        # The shared client's timeout is shorter than a long poll
+        r = await main.tg_client().post(f"{main.TG_API}/getUpdates", json=payload, timeout=POLL_TIMEOUT + 10)
+        data = r.json()
+    except Exception as e:
+        log.warning("getUpdates failed: %s", e)
+        return None
+    if not main.tg_ok(data):
+        log.warning("getUpdates error: %s", data)
+        return None
+    return data.get("result") or []
+
+async def _run_chat(updates: list):
+    for update in updates:
+        try:
+            await main.handle_update(update)
+        except Exception:
+            log.exception("update %s failed", update.get("update_id"))
+
+async def process_batch(updates: list):
+    by_chat: dict = {}
+    for update in updates:
+        by_chat.setdefault(main._chat_key(update), []).append(update)
+    await asyncio.gather(*(_run_chat(chain) for chain in by_chat.values()))
+
+async def run():
+    async with main.lifespan(main.app):
+        if POLL_DELETE_WEBHOOK:
+            await main.tg("deleteWebhook", {"drop_pending_updates": False})
+        offset = int(await main.r_get(OFFSET_KEY) or 0)
+        backoff = 1.0
+        while True:
+            updates = await get_updates(offset)
+            if updates is None:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            if not updates:
+                continue
+            await process_batch(updates)
+            offset = updates[-1]["update_id"] + 1
+            await main.r_set(OFFSET_KEY, str(offset))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
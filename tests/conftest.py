@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import sys
+
+# main reads its settings at import time
+os.environ.update(
+    STORAGE_BACKEND="memory",
+    BOT_TOKEN="123:test",
+    ADMIN_ID="1",
+    BROADCAST_RATE="1000",
+    WEBHOOK_MODE="inline",
+    WEBHOOK_REPLY="0",
+    TRACE_SAMPLE="0",
+    SLOW_UPDATE_MS="0",
+    MEDIA_PREWARM="0",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import pytest
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def message(uid, text, update_id):
+    return {"update_id": update_id, "message": {"message_id": 5, "chat": {"id": uid},
+                                                "from": {"id": uid, "first_name": "A"}, "text": text}}
+
+
+def callback(uid, data, update_id):
+    return {"update_id": update_id, "callback_query": {"id": f"cb{update_id}", "from": {"id": uid}, "data": data}}
+
+
+async def post_all(updates):
+    """POST updates to /webhook concurrently; returns the response bodies."""
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        return [r.json() for r in await asyncio.gather(*(c.post("/webhook", json=u) for u in updates))]
+
+
+class FakeTelegram:
+    """Records Bot API calls; `responses[method]` overrides the default ok reply."""
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self.responses: dict = {}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        method = request.url.path.rsplit("/", 1)[-1]
+        body = json.loads(request.content or b"{}")
+        self.calls.append((method, body))
+        resp = self.responses.get(method)
+        if callable(resp):
+            resp = resp(body)
+        return httpx.Response(200, json=resp or {"ok": True, "result": {"message_id": 1}})
+
+    def sent_to(self, chat_id) -> list[tuple[str, dict]]:
+        return [(m, b) for m, b in self.calls if b.get("chat_id") == chat_id]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    s = main.MemoryStore()
+    monkeypatch.setattr(main, "STORE", s)
+    monkeypatch.setattr(main, "_SEEN_UPDATES", main.LRUCache(1000))
+    monkeypatch.setattr(main, "_LANG_CACHE", main.LRUCache(1000))
+    return s
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    fake = FakeTelegram()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handle))
+    monkeypatch.setitem(main._CLIENTS, "telegram", client)
+    return fake
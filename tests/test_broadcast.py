@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import time
+
+import main
+from conftest import message, post_all, run
+
+SPEC = {"kind": "message", "payload": {"text": "hi"}}
+
+
+def test_finished_local_run_is_reported_not_restarted(store, telegram, monkeypatch):
+    store.call("SADD", "subs", *map(str, range(100, 110)))
+
+    async def no_clear(self):
+        pass  # the worker dies between the last checkpoint and clearing it
+
+    async def flow(clear):
+        lease = main.Lease("blast")
+        assert await lease.acquire()
+        with monkeypatch.context() as m:
+            if not clear:
+                m.setattr(main.Lease, "clear_checkpoint", no_clear)
+            await main.run_local(1, SPEC, "Sent to {n}.", None, lease)
+        await lease.release()
+
+    run(flow(clear=False))
+    assert store.call("HGET", "bcast:blast", "done") == "1"
+    telegram.calls.clear()
+
+    run(flow(clear=True))
+    assert [b["text"] for _, b in telegram.calls] == ["Sent to 10."]
+    assert store.call("HGETALL", "bcast:blast") == []
+
+
+def job_keys(jid="1"):
+    key = f"bcast:job:{jid}"
+    return key, [f"{key}:todo", f"{key}:claims", f"{key}:pages"]
+
+
+def test_sharded_job_reaches_every_subscriber_once(store, telegram, monkeypatch):
+    monkeypatch.setattr(main, "_SHARD_PAGE_IDS", 4)
+    monkeypatch.setattr(main, "SHARD_POLL_SECS", 0.01)
+    store.call("SADD", "subs", *map(str, range(100, 130)))
+
+    async def flow():
+        await main.run_sharded(1, SPEC, "Sent to {n}.", None, None)
+        workers = [asyncio.create_task(main.shard_worker()) for _ in range(3)]
+        for _ in range(200):
+            if await main.r_cmd("HGET", "bcast:job:1", "finished") == "1":
+                break
+            await asyncio.sleep(0.01)
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    run(flow())
+    per_chat = collections.Counter(b["chat_id"] for m, b in telegram.calls if b.get("text") == "hi")
+    assert sorted(per_chat) == list(range(100, 130))
+    assert set(per_chat.values()) == {1}
+    assert store.call("HGET", "bcast:job:1", "total") == "8"  # SSCAN pages cut to 4 ids
+    assert telegram.sent_to(1)[-1][1]["text"] == "Sent to 30."
+
+
+def test_reaped_claim_cannot_complete_the_page(store):
+    key, keys = job_keys()
+    store.call("RPUSH", f"{key}:todo", "0")
+    store.call("HSET", f"{key}:pages", "0", "[5, 6]")
+
+    async def flow():
+        first = await main.r_eval(main._CLAIM_LUA, keys, [int(time.time()) - 1, "a"])
+        reaped = await main.r_eval(main._REAP_LUA, [f"{key}:claims", f"{key}:todo"], [int(time.time())])
+        second = await main.r_eval(main._CLAIM_LUA, keys, [int(time.time()) + 60, "b"])
+        renew_a = await main.r_eval(main._RENEW_CLAIM_LUA, [f"{key}:claims"], ["0", "a", 999])
+        done_a = await main.r_eval(main._PAGE_DONE_LUA, [f"{key}:claims", key, f"{key}:pages"], ["0", 2, 0, "a"])
+        done_b = await main.r_eval(main._PAGE_DONE_LUA, [f"{key}:claims", key, f"{key}:pages"], ["0", 2, 0, "b"])
+        return first, reaped, second, renew_a, done_a, done_b
+
+    first, reaped, second, renew_a, done_a, done_b = run(flow())
+    assert first == ["0", "[5, 6]"] and second == ["0", "[5, 6]"]
+    assert reaped == 1
+    assert (renew_a, done_a, done_b) == (0, 0, 1)
+    assert store.call("HGET", key, "sent") == "2"
+
+
+def test_claim_heartbeat_pushes_the_deadline_out(store, monkeypatch):
+    key, keys = job_keys()
+    store.call("RPUSH", f"{key}:todo", "0")
+    monkeypatch.setattr(main, "SHARD_CLAIM_SECS", 0.03)
+
+    async def flow():
+        await main.r_eval(main._CLAIM_LUA, keys, [0, "tok"])
+        claim = main.ShardClaim(f"{key}:claims", "0", "tok")
+        await asyncio.sleep(0.05)
+        claim.stop()
+        return claim.lost, await main.r_cmd("HGET", f"{key}:claims", "0")
+
+    lost, value = run(flow())
+    assert not lost
+    deadline, _, owner = value.partition(":")
+    assert owner == "tok" and int(deadline) >= int(time.time())
+
+
+def orphan_job(store, owner_until):
+    """A /broadcast job whose coordinator died after feeding one page of two ids."""
+    key, _ = job_keys("4")
+    store.call("HSET", key, "spec", '{"kind": "message", "payload": {"text": "hi"}}', "admin", "1",
+               "done", "Sent to {n}.", "empty", "", "total", "1", "fed", "0", "owner_until", str(owner_until))
+    store.call("HSET", f"{key}:pages", "0", "[200, 201]")
+    store.call("RPUSH", f"{key}:todo", "0")
+    store.call("SADD", "bcast:jobs", "4")
+    return key
+
+
+def test_workers_retire_a_job_whose_coordinator_lapsed(store, telegram):
+    key = orphan_job(store, int(time.time()) - 1)
+
+    async def flow():
+        while await main._work_job("4"):
+            pass
+
+    run(flow())
+    assert sorted(b["chat_id"] for _, b in telegram.calls if b.get("text") == "hi") == [200, 201]
+    report = telegram.sent_to(1)[-1][1]["text"]
+    assert report.startswith("Sent to 2.") and "Stopped early" in report
+    assert store.call("SMEMBERS", "bcast:jobs") == []
+    assert store.call("HGET", key, "finished") == "1"
+
+
+def test_workers_wait_for_a_live_coordinator(store, telegram):
+    orphan_job(store, int(time.time()) + 60)
+
+    async def flow():
+        while await main._work_job("4"):
+            pass
+
+    run(flow())
+    assert telegram.sent_to(1) == []
+    assert store.call("SMEMBERS", "bcast:jobs") == ["4"]
+
+
+DEAD = {
+    101: {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"},
+    102: {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"},
+    103: {"ok": False, "error_code": 400, "description": "Bad Request: message is too long"},
+}
+
+
+def test_delivery_outcomes():
+    assert main.delivery_outcome({"ok": True, "result": {}}) == "ok"
+    assert [main.delivery_outcome(DEAD[u]) for u in (101, 102, 103)] == ["blocked", "gone", "error"]
+    assert main.delivery_outcome({"ok": False, "error_code": 429}) == "rate_limited"
+    assert main.delivery_outcome(None) == "error"
+
+
+def test_broadcast_prunes_only_dead_chats(store, telegram):
+    store.call("SADD", "subs", *map(str, range(100, 105)))
+    telegram.responses["sendMessage"] = lambda body: DEAD.get(body["chat_id"])
+
+    run(main.run_local(1, SPEC, "Sent to {n}.", None, None))
+    assert sorted(store.call("SMEMBERS", "subs")) == ["100", "103", "104"]
+    assert sorted(store.call("SMEMBERS", "subs:inactive")) == ["101", "102"]
+    assert store.call("HGETALL", "subs:pruned") == ["blocked", "1", "gone", "1"]
+    assert telegram.sent_to(1)[-1][1]["text"] == "Sent to 2.\nFailed: 3"
+
+
+def test_pruned_user_who_returns_is_reactivated_not_new(store, telegram):
+    store.call("SADD", "subs:inactive", "101")
+    run(post_all([message(101, "/start ref_7", 800)]))
+    assert store.call("SMEMBERS", "subs") == ["101"]
+    assert store.call("SMEMBERS", "subs:inactive") == []
+    assert store.call("ZSCORE", "shares", "7") is None  # not a new subscriber: no referral credit
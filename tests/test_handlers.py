@@ -0,0 +1,160 @@
+import asyncio
+
+import httpx
+
+import main
+import polling
+from conftest import callback, message, post_all, run
+
+
+def slow_telegram(monkeypatch, secs):
+    calls = []
+
+    async def fake_tg(method, payload):
+        calls.append((method, payload))
+        await asyncio.sleep(secs)
+        return {"ok": True, "result": {"message_id": 1}}
+
+    monkeypatch.setattr(main, "_tg", fake_tg)
+    return calls
+
+
+def test_admission_hands_freed_slots_to_the_highest_lane():
+    gate = main.Admission(1, waits=(1, 1, 0))
+    order = []
+
+    async def flow():
+        assert await gate.acquire(0)
+        assert not await gate.acquire(2)  # chatter doesn't wait
+
+        async def waiter(lane):
+            if await gate.acquire(lane):
+                order.append(lane)
+                gate.release()
+
+        tasks = [asyncio.create_task(waiter(1)), asyncio.create_task(waiter(0))]
+        await asyncio.sleep(0)
+        gate.release()
+        await asyncio.gather(*tasks)
+
+    run(flow())
+    assert order == [0, 1]
+    assert gate.inflight == 0 and gate.waiting() == 0
+
+
+def test_admission_keeps_a_slot_handed_over_as_the_wait_times_out(monkeypatch):
+    gate = main.Admission(1, waits=(1, 1, 0))
+
+    async def racy_wait_for(fut, timeout):
+        # What 3.12+ does when release() and the timeout land in the same tick
+        gate.release()
+        raise asyncio.TimeoutError
+
+    async def flow():
+        assert await gate.acquire(0)
+        with monkeypatch.context() as m:
+            m.setattr(asyncio, "wait_for", racy_wait_for)
+            got = await gate.acquire(0)
+        held = gate.inflight
+        if got:
+            gate.release()
+        return got, held
+
+    assert run(flow()) == (True, 1)
+    assert gate.inflight == 0
+
+
+def test_webhook_sheds_chatter_but_polling_never_does(store, monkeypatch):
+    monkeypatch.setattr(main, "_ADMISSION", main.Admission(2, waits=(1, 1, 0)))
+    calls = slow_telegram(monkeypatch, 0.02)
+    chatter = [message(1000 + i, "lol random", 10 + i) for i in range(6)]
+
+    run(post_all(chatter))
+    assert main.STATS.get("shed_chatter", 0) >= 4
+    assert len(calls) == 2
+
+    calls.clear()
+    run(polling.process_batch([message(2000 + i, "lol random", 100 + i) for i in range(6)]))
+    assert len(calls) == 6
+
+
+def test_start_with_ref_credits_only_a_new_subscriber(store, telegram):
+    run(post_all([message(56, "/start ref_7", 600)]))
+    run(post_all([message(56, "/start ref_7", 601)]))
+    assert store.call("ZSCORE", "shares", "7") == "1"
+
+
+def test_single_reply_rides_on_the_webhook_response(store, telegram, monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_REPLY", True)
+    (body,) = run(post_all([callback(8, "language", 500)]))
+    assert body["method"] == "sendMessage" and body["chat_id"] == 8
+    assert telegram.calls == []
+
+
+def test_later_calls_send_the_held_reply_first(store, telegram, monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_REPLY", True)
+    (body,) = run(post_all([callback(8, "access", 501)]))
+    assert body == {"ok": True}
+    assert [m for m, _ in telegram.calls] == ["answerCallbackQuery", "sendMessage"]
+
+
+def test_held_reply_is_sent_before_concurrent_calls(store, monkeypatch):
+    calls = slow_telegram(monkeypatch, 0.01)
+
+    async def flow():
+        main._REPLY_SLOT.set([])
+        await main.concurrently(
+            main.reply("sendMessage", {"chat_id": 1, "text": "ack"}),
+            main.tg("sendMessage", {"chat_id": 1, "text": "b"}),
+            main.tg("sendMessage", {"chat_id": 1, "text": "c"}),
+        )
+
+    run(flow())
+    assert [p["text"] for _, p in calls][0] == "ack"
+    assert sorted(p["text"] for _, p in calls) == ["ack", "b", "c"]
+
+
+def test_concurrently_isolates_failing_and_slow_steps():
+    async def boom():
+        raise RuntimeError("x")
+
+    async def slow():
+        await asyncio.sleep(5)
+
+    async def ok():
+        return 2
+
+    assert run(main.concurrently(boom(), slow(), None, ok(), timeout=0.05)) == [None, None, None, 2]
+
+
+def test_bot_username_is_retried_and_the_ui_rebuilt(store, telegram, monkeypatch):
+    monkeypatch.setattr(main, "BOT_USERNAME", "")
+    monkeypatch.setattr(main, "CONFIG_REFRESH_SECS", 0.01)
+    answers = iter([{"ok": False, "error_code": 502, "description": "Bad Gateway"}])
+    telegram.responses["getMe"] = lambda body: next(answers, {"ok": True, "result": {"username": "GainBot"}})
+
+    async def flow():
+        assert not await main.resolve_bot_username()  # boot-time failure
+        main.build_ui_templates()
+        before = main.ui_call(56)[1]
+        refresher = asyncio.create_task(main.config_refresher())
+        await asyncio.sleep(0.05)
+        refresher.cancel()
+        return before, main.ui_call(56)[1]
+
+    before, after = run(flow())
+    assert main.BOT_USERNAME == "GainBot"
+    assert b"start%3Dref_56" not in before and b"start%3Dref_56" in after
+
+
+def test_debug_traces_only_accept_the_header(monkeypatch):
+    monkeypatch.setattr(main, "DEBUG_TOKEN", "s3cret")
+
+    async def get(**kw):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            return (await c.get("/debug/traces", **kw)).status_code
+
+    assert run(get(headers={"X-Debug-Token": "s3cret"})) == 200
+    assert run(get(params={"token": "s3cret"})) == 404
+    assert run(get(headers={"X-Debug-Token": "nope"})) == 404
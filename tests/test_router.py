@@ -0,0 +1,59 @@
+import main
+from conftest import message, post_all, run
+
+
+def old_faq_reply(low):
+    # The if-chain the FAQ matcher replaced: first entry with any keyword in the text
+    for keys, answer in main.FAQ:
+        if any(k in low for k in keys):
+            return answer
+    return None
+
+
+def test_parse_command_strips_bot_suffix_and_splits_args():
+    assert main.parse_command("/Start@GainBot ref_1") == ("start", "ref_1")
+    assert main.parse_command("/help") == ("help", "")
+    assert main.parse_command("/setchannellabel  Dark | https://t.me/x ") == ("setchannellabel", "Dark | https://t.me/x")
+    assert main.parse_command("hello /help") == (None, "hello /help")
+    assert main.parse_command("/") == (None, "")
+
+
+def test_faq_matches_the_old_first_entry_wins_loop():
+    keys = [k for entry, _ in main.FAQ for k in entry]
+    texts = ["", "hello there", "what does it cost to unlock", "lang access", "how to join channel and change language",
+             "my share not counting, contact admin", "access " * 3, "langauge", "HOW MUCH".lower()]
+    texts += [f"{a} and {b}" for a in keys for b in keys]
+    texts += [a + b for a in keys for b in keys]  # keywords overlapping across the seam
+    for t in texts:
+        assert main.faq_reply(t) == old_faq_reply(t), t
+
+
+def test_commands_win_over_the_faq(store, telegram):
+    # "/language" contains the FAQ keyword "language"; the command must answer
+    run(post_all([message(56, "/language", 700)]))
+    ((method, body),) = telegram.calls
+    assert method == "sendMessage" and body["reply_markup"] == main.LANG_KEYBOARD
+
+
+def test_command_with_bot_suffix_is_routed(store, telegram):
+    run(post_all([message(56, "/progress@GainBot", 701)]))
+    ((_, body),) = telegram.calls
+    assert f"/{main.GOAL}" in body["text"]
+
+
+def test_admin_commands_are_invisible_to_other_users(store, telegram):
+    run(post_all([message(56, "/unlockblast", 702), message(57, "/results 1", 703), message(58, "/broadcast hi", 704)]))
+    assert telegram.calls == []
+    assert store.call("SCARD", "bcast:jobs") == 0
+
+
+def test_admin_commands_work_for_the_admin(store, telegram):
+    run(post_all([message(main.ADMIN_ID, "/unlockblast", 705)]))
+    assert telegram.sent_to(main.ADMIN_ID)
+
+
+def test_unmatched_text_gets_the_fallback(store, telegram):
+    run(post_all([message(56, "hello there", 706), message(57, "how much is it", 707)]))
+    texts = {b["chat_id"]: b["text"] for _, b in telegram.calls}
+    assert texts[56].startswith("Got it!")
+    assert texts[57] == old_faq_reply("how much is it")
@@ -0,0 +1,108 @@
+import main
+from conftest import run
+
+
+def test_sscan_keeps_members_when_earlier_ones_are_removed(store):
+    members = [f"m{i:02d}" for i in range(10)]
+    store.call("SADD", "s", *members)
+
+    async def scan():
+        seen, cursor = [], "0"
+        while True:
+            cursor, page = await main.r_cmd("SSCAN", "s", cursor, "COUNT", 4)
+            seen += page
+            if page and page[0] == "m00":
+                # Broadcasts prune dead chats from the page they just sent
+                await main.r_cmd("SREM", "s", "m00", "m01", "m02")
+            if cursor == "0":
+                return seen
+
+    assert run(scan()) == members
+
+
+def test_sscan_pages_cover_the_set(store):
+    store.call("SADD", "subs", *map(str, range(25)))
+
+    async def pages():
+        return [page async for _, page in main.r_sscan_pages("subs", count=7)]
+
+    got = run(pages())
+    assert [len(p) for p in got] == [7, 7, 7, 4]
+    assert sorted(sum(got, []), key=int) == [str(i) for i in range(25)]
+
+
+def test_vote_twin_moves_counts_between_options(store):
+    async def flow():
+        pid = await main.create_poll("Q?", ["a", "b"])
+        res = [
+            await main.record_vote(pid, 7, "0"),
+            await main.record_vote(pid, 7, "0"),
+            await main.record_vote(pid, 7, "1"),
+            await main.record_vote(pid, 8, "5"),
+        ]
+        return res, await main.poll_results(pid)
+
+    res, results = run(flow())
+    assert res == [1, 0, 1, -1]
+    assert results == ("Q?", [("a", 0), ("b", 1)])
+
+
+def test_old_layout_polls_are_migrated_on_first_vote(store):
+    store.call("SET", "poll:3:q", "Old?")
+    store.call("SET", "poll:3:opts", "x|y|z")
+    store.call("HSET", "poll:3:votes", "7", "2", "8", "2", "9", "0")
+
+    async def flow():
+        counted = await main.record_vote("3", 10, "1")
+        changed = await main.record_vote("3", 7, "0")
+        return counted, changed, await main.poll_results("3")
+
+    counted, changed, results = run(flow())
+    assert (counted, changed) == (1, 1)
+    assert results == ("Old?", [("x", 2), ("y", 1), ("z", 1)])
+    assert store.call("GET", "poll:3:opts") is None
+
+
+def test_old_layout_poll_results_are_readable(store):
+    store.call("SET", "poll:4:q", "Old?")
+    store.call("SET", "poll:4:opts", "x|y")
+    store.call("HSET", "poll:4:votes", "7", "1")
+
+    assert run(main.poll_results("4")) == ("Old?", [("x", 0), ("y", 1)])
+    assert run(main.poll_results("5")) is None
+
+
+def test_lease_is_exclusive_and_fences_checkpoints(store):
+    async def flow():
+        first, second = main.Lease("blast"), main.Lease("blast")
+        assert await first.acquire()
+        assert not await second.acquire()
+        assert await first.save_checkpoint(cursor="5", sent=5)
+
+        # The first holder stalls past its TTL and someone else takes over
+        await main.r_del("lock:blast")
+        assert await second.acquire()
+        assert not await first.save_checkpoint(cursor="9", sent=9)
+        assert first.lost
+        ck = await second.checkpoint()
+        await first.release()
+        held = await main.r_get("lock:blast")
+        await second.release()
+        return ck, held, second.token, await main.r_get("lock:blast")
+
+    ck, held, token, after = run(flow())
+    assert ck == {"cursor": "5", "sent": "5"}
+    assert held is not None  # the stale holder's release left the new lease alone
+    assert token is None and after is None
+
+
+def test_lease_treats_legacy_zero_flag_as_free(store):
+    store.call("SET", "lock:blast", "0")
+
+    async def flow():
+        lease = main.Lease("blast")
+        ok = await lease.acquire()
+        await lease.release()
+        return ok
+
+    assert run(flow())